@@ -0,0 +1,11 @@
+#!/usr/bin/env bash
+
+python -m src.batch_infer \
+    --agent_api http://localhost:9891/generate \
+    --retriever_api http://localhost:9892/search \
+    --gen_api http://localhost:9893/generate \
+    --rearag_tokenizer_path THU-KEG/ReaRAG-9B \
+    --ans_tokenizer_path ZhipuAI/glm-4-9b-chat \
+    --input_file data/questions.jsonl \
+    --output_file data/predictions.jsonl \
+    --num_workers 128
@@ -11,10 +11,14 @@ mkdir -p logs
 
 # ################################### 1. DEPLOY REARAG ###################################
 echo "Starting REARAG..."
-CUDA_VISIBLE_DEVICES=$GPU_FOR_REARAG nohup python vllm_serving.py \
-  --model_path $REARAG_MODEL_DIR \
+# Served by the async engine (continuous batching), so that concurrent agents of batch_infer.py
+# and --stream_agent are supported. vllm_serving.py handles one request at a time.
+CUDA_VISIBLE_DEVICES=$GPU_FOR_REARAG nohup python vllm_async_serving.py \
+  --model $REARAG_MODEL_DIR \
   --tensor_parallel_size 1 \
   --gpu_memory_utilization 0.6 \
+  --seed 0 \
+  --trust-remote-code \
   --host $REARAG_HOST \
   --port $REARAG_PORT \
   > logs/rearag.log 2>&1 &
@@ -12,3 +12,13 @@ ANSWER_LLM_PORT=9893
 REARAG_HOST="127.0.0.1"
 RETRIEVER_HOST="127.0.0.1"
 ANSWER_LLM_HOST="127.0.0.1"
+
+# Concurrent /search requests batched into one batch_search by the retriever (1 disables batching)
+RETRIEVER_MAX_BATCH_SIZE=32
+RETRIEVER_MAX_BATCH_WAIT_MS=5
+
+# Retriever server processes. With more than 1, set faiss_gpu: False and faiss_mmap: True in
+# retriever_config.yaml so that the workers share the index and corpus pages instead of copying them.
+# Flat indexes (such as e5_flat_inner.index) can only be mapped by faiss versions providing IO_FLAG_MMAP_IFC,
+# retriever_serving.py refuses to start several workers otherwise
+RETRIEVER_WORKERS=1
@@ -15,6 +15,9 @@ CUDA_VISIBLE_DEVICES=$GPU_FOR_RETRIEVER nohup python retriever_serving.py \
     --config retriever_config.yaml \
     --num_retriever 1 \
     --port $RETRIEVER_PORT \
+    --max_batch_size $RETRIEVER_MAX_BATCH_SIZE \
+    --max_batch_wait_ms $RETRIEVER_MAX_BATCH_WAIT_MS \
+    --workers $RETRIEVER_WORKERS \
   > logs/retriever.log 2>&1 &
 
 sleep 5
@@ -17,6 +17,23 @@ import requests
 from functools import wraps
 import time
 
+def faiss_mmap_flags():
+    """
+    IO flags of faiss.read_index memory-mapping as much of an index as this faiss version supports:
+    IO_FLAG_MMAP maps the inverted lists of IVF indexes, IO_FLAG_MMAP_IFC (recent versions only)
+    maps the codes of flat indexes (IndexFlatCodes). Everything else is read into memory.
+    """
+    flags = faiss.IO_FLAG_MMAP
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        flags |= faiss.IO_FLAG_MMAP_IFC
+    return flags
+
+def faiss_index_is_mmapped(index):
+    """Whether the bulk of an index read with faiss_mmap_flags() stays in the mapped file."""
+    if faiss.try_extract_index_ivf(index) is not None:
+        return True
+    return hasattr(faiss, "IO_FLAG_MMAP_IFC") and isinstance(index, faiss.IndexFlatCodes)
+
 def cache_manager(func):
     """
     Decorator used for retrieving document cache.
@@ -350,7 +367,14 @@ class DenseRetriever(BaseTextRetriever):
     def load_index(self):
         if self.index_path is None or not os.path.exists(self.index_path):
             raise Warning(f"Index file {self.index_path} does not exist!")
-        self.index = faiss.read_index(self.index_path)
+        if self.use_faiss_mmap and not self.use_faiss_gpu:
+            # Pages of the index are loaded on demand and shared by every process mapping the file
+            self.index = faiss.read_index(self.index_path, faiss_mmap_flags())
+            if not faiss_index_is_mmapped(self.index):
+                warnings.warn(f"faiss_mmap: {type(self.index).__name__} cannot be memory-mapped by faiss {faiss.__version__} "
+                              f"(flat indexes need IO_FLAG_MMAP_IFC), {self.index_path} was read into memory")
+        else:
+            self.index = faiss.read_index(self.index_path)
         if self.use_faiss_gpu:
             co = faiss.GpuMultipleClonerOptions()
             co.useFloat16 = True
@@ -368,6 +392,7 @@ class DenseRetriever(BaseTextRetriever):
         self.retreival_model_path = self._config['retrieval_model_path']
         self.use_st = self._config["use_sentence_transformer"]
         self.use_faiss_gpu = self._config['faiss_gpu']
+        self.use_faiss_mmap = self._config['faiss_mmap']
 
     def load_model(self):
         if self.use_st:
@@ -2,38 +2,197 @@ from fastapi import FastAPI, HTTPException
 import argparse
 from pydantic import BaseModel
 from typing import List, Tuple, Union
+import os
+import copy
+import json
 import asyncio
+import threading
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from flashrag.config import Config
 from flashrag.utils import get_retriever
+from flashrag.retriever import DenseRetriever, load_corpus, faiss_mmap_flags, faiss_index_is_mmapped
 
 app = FastAPI()
 
 retriever_list = []
 available_retrievers = deque()
 retriever_semaphore = None
+retriever_executor = None
+search_batcher = None
+
+class LockedIndex:
+    """GPU FAISS indexes are not thread-safe, searches of the replicas sharing one are serialized."""
+    def __init__(self, index):
+        self.index = index
+        self.lock = threading.Lock()
+
+    def search(self, *args, **kwargs):
+        with self.lock:
+            return self.index.search(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+def replicate_retriever(retriever):
+    """
+    New replica of a dense retriever, which shares its corpus and FAISS index (both read-only)
+    and only gets its own query encoder. Other retrievers are not replicated.
+    """
+    if not isinstance(retriever, DenseRetriever):
+        return None
+    if retriever.use_faiss_gpu and not isinstance(retriever.index, LockedIndex):
+        retriever.index = LockedIndex(retriever.index)
+    replica = copy.copy(retriever)
+    replica.load_model()
+    return replica
 
 def init_retriever(args):
-    global retriever_semaphore
+    global retriever_semaphore, retriever_executor
     config = Config(args.config)
+    if args.faiss_mmap:
+        config["faiss_mmap"] = True
     for i in range(args.num_retriever):
         print(f"Initializing retriever {i+1}/{args.num_retriever}")
-        retriever = get_retriever(config)
+        retriever = replicate_retriever(retriever_list[0]) if retriever_list else None
+        if retriever is None:
+            retriever = get_retriever(config)
         retriever_list.append(retriever)
         available_retrievers.append(i)
     # create a semaphore to limit the number of retrievers that can be used concurrently
     retriever_semaphore = asyncio.Semaphore(args.num_retriever)
+    # Retrieval is blocking, it runs on these threads to keep the event loop responsive.
+    # FAISS and torch release the GIL, so the retrievers run in parallel
+    retriever_executor = ThreadPoolExecutor(max_workers=args.num_retriever, thread_name_prefix="retriever")
+
+async def run_retriever(method, *args):
+    """
+    Call `method` of a free retriever on the retriever executor, one call per retriever at a time.
+    """
+    await retriever_semaphore.acquire()
+    retriever_idx = available_retrievers.popleft()
+
+    def release(_):
+        available_retrievers.append(retriever_idx)
+        retriever_semaphore.release()
+
+    fn = getattr(retriever_list[retriever_idx], method)
+    future = asyncio.get_running_loop().run_in_executor(retriever_executor, fn, *args)
+    # The retriever is released once its call is over, even if the request was cancelled meanwhile
+    future.add_done_callback(release)
+    return await asyncio.shield(future)
+
+class SearchBatcher:
+    def __init__(self, max_batch_size, max_wait_ms):
+        """
+        Collect concurrent /search requests and run them as one batch_search, i.e. one encoder
+        forward pass and one multi-row FAISS search, then fan the results back out.
+        A batch is dispatched when it has `max_batch_size` queries, or `max_wait_ms` after its first query arrived.
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.n_queries = 0
+        self.n_batches = 0
+
+    def start(self):
+        asyncio.create_task(self.collect())
+
+    async def search(self, query, top_n):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, top_n, future))
+        return await future
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.n_queries += len(batch)
+            self.n_batches += 1
+            # Keep collecting the next batch while this one runs
+            asyncio.create_task(self.run(batch))
+
+    async def run(self, batch):
+        # Results are sorted by score, so the top_n of every request is a prefix of the largest top_n
+        max_top_n = max(top_n for _, top_n, _ in batch)
+        try:
+            results, scores = await run_retriever("batch_search", [query for query, _, _ in batch], max_top_n, True)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, top_n, future), item_results, item_scores in zip(batch, results, scores):
+            if not future.done(): # The request may have been cancelled
+                future.set_result((item_results[:top_n], item_scores[:top_n]))
+
+# In multi-worker mode, every worker process gets the server arguments through this variable
+WORKER_ARGS_ENV = "RETRIEVER_SERVING_ARGS"
+
+def build_search_batcher(args):
+    if args.max_batch_size > 1:
+        return SearchBatcher(args.max_batch_size, args.max_batch_wait_ms)
+    return None
+
+@app.on_event("startup")
+async def startup():
+    global search_batcher
+    if not retriever_list and WORKER_ARGS_ENV in os.environ:
+        args = argparse.Namespace(**json.loads(os.environ[WORKER_ARGS_ENV]))
+        print(f"Worker {os.getpid()}: initializing retrievers")
+        init_retriever(args)
+        search_batcher = build_search_batcher(args)
+    if search_batcher is not None:
+        search_batcher.start()
+
+def prepare_shared_files(args):
+    """
+    Build the Arrow cache of the corpus once before starting the workers, so that they all map
+    the same file instead of converting the corpus concurrently.
+    """
+    config = Config(args.config)
+    load_corpus(config["corpus_path"])
+    if config["faiss_gpu"]:
+        print("Warning: faiss_gpu is set, every worker loads its own copy of the index on the GPUs")
+    elif not (config["faiss_mmap"] or args.faiss_mmap):
+        print("Warning: faiss_mmap is not set, every worker reads its own copy of the index into memory")
+    else:
+        import faiss
+        # Checked once here rather than in every worker, an index that cannot be mapped would be copied N times
+        index = faiss.read_index(config["index_path"], faiss_mmap_flags())
+        is_mmapped = faiss_index_is_mmapped(index)
+        index_type = type(index).__name__
+        del index
+        if not is_mmapped:
+            raise SystemExit(f"--workers {args.workers}: {index_type} cannot be memory-mapped by faiss {faiss.__version__} "
+                             f"(flat indexes need IO_FLAG_MMAP_IFC, IVF indexes are always mapped), every worker would "
+                             f"read its own copy of {config['index_path']}. Upgrade faiss, use an IVF index, or run one worker.")
 
 @app.get("/health")
 async def health_check():
-    return {
+    status = {
         "status": "healthy",
         "retrievers": {
             "total": len(retriever_list),
             "available": len(available_retrievers)
         }
     }
+    if search_batcher is not None:
+        status["batching"] = {
+            "queries": search_batcher.n_queries,
+            "batches": search_batcher.n_batches,
+        }
+    return status
 
 class QueryRequest(BaseModel):
     query: str
@@ -62,17 +221,17 @@ async def search(request: QueryRequest):
             detail="Query content cannot be empty"
         )
 
-    async with retriever_semaphore:
-        retriever_idx = available_retrievers.popleft()
-        try:
-            if return_score:
-                results, scores = retriever_list[retriever_idx].search(query, top_n, return_score)
-                return [Document(id=result['id'], contents=result['contents']) for result in results], scores
-            else:
-                results = retriever_list[retriever_idx].search(query, top_n, return_score)
-                return [Document(id=result['id'], contents=result['contents']) for result in results]
-        finally:
-            available_retrievers.append(retriever_idx)
+    if search_batcher is not None:
+        results, scores = await search_batcher.search(query, top_n)
+        documents = [Document(id=result['id'], contents=result['contents']) for result in results]
+        return (documents, scores) if return_score else documents
+
+    if return_score:
+        results, scores = await run_retriever("search", query, top_n, return_score)
+        return [Document(id=result['id'], contents=result['contents']) for result in results], scores
+    else:
+        results = await run_retriever("search", query, top_n, return_score)
+        return [Document(id=result['id'], contents=result['contents']) for result in results]
 
 @app.post("/batch_search", response_model=Union[List[List[Document]], Tuple[List[List[Document]], List[List[float]]]])
 async def batch_search(request: BatchQueryRequest):
@@ -80,27 +239,39 @@ async def batch_search(request: BatchQueryRequest):
     top_n = request.top_n
     return_score = request.return_score
 
-    async with retriever_semaphore:
-        retriever_idx = available_retrievers.popleft()
-        try:
-            if return_score:
-                results, scores = retriever_list[retriever_idx].batch_search(query, top_n, return_score)
-                return [[Document(id=result['id'], contents=result['contents']) for result in results[i]] for i in range(len(results))], scores
-            else:
-                results = retriever_list[retriever_idx].batch_search(query, top_n, return_score)
-                return [[Document(id=result['id'], contents=result['contents']) for result in results[i]] for i in range(len(results))]
-        finally:
-            available_retrievers.append(retriever_idx)
+    if return_score:
+        results, scores = await run_retriever("batch_search", query, top_n, return_score)
+        return [[Document(id=result['id'], contents=result['contents']) for result in results[i]] for i in range(len(results))], scores
+    else:
+        results = await run_retriever("batch_search", query, top_n, return_score)
+        return [[Document(id=result['id'], contents=result['contents']) for result in results[i]] for i in range(len(results))]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="./retriever_config.yaml")
     parser.add_argument("--num_retriever", type=int, default=1)
     parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--max_batch_size", type=int, default=1,
+                        help="gather up to this many concurrent /search requests into one batch_search, 1 disables batching")
+    parser.add_argument("--max_batch_wait_ms", type=float, default=5,
+                        help="how long a /search request waits for others to join its batch")
+    parser.add_argument("--faiss_mmap", action="store_true",
+                        help="memory-map the FAISS index file instead of reading it into memory (CPU index only). "
+                             "IVF indexes are always mapped, flat indexes only with faiss versions providing IO_FLAG_MMAP_IFC")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of server processes, each runs --num_retriever retrievers. "
+                             "Workers memory-map the same index and corpus, use with --faiss_mmap (refused if the index cannot be mapped)")
     args = parser.parse_args()
-    
-    init_retriever(args)
 
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
+    if args.workers > 1:
+        # Every worker imports this module and initializes its retrievers on startup
+        prepare_shared_files(args)
+        os.environ[WORKER_ARGS_ENV] = json.dumps(vars(args))
+        module = os.path.splitext(os.path.basename(__file__))[0]
+        uvicorn.run(f"{module}:app", host="0.0.0.0", port=args.port, workers=args.workers)
+    else:
+        init_retriever(args)
+        search_batcher = build_search_batcher(args)
+        uvicorn.run(app, host="0.0.0.0", port=args.port)
 
@@ -6,6 +6,10 @@ app = Flask(__name__)
 
 global llm_model
 
+@app.get("/health")
+def health():
+    return jsonify({'status': 'healthy'})
+
 @app.post("/generate")
 def generate():
 
@@ -0,0 +1,124 @@
+"""
+Shared parser for the Thought/Action/Observation steps generated by the models.
+
+Actions are written by the model as Python dict literals, e.g.
+    {'function': 'search', 'parameters': {'query': 'Who wrote Hannibal and Scipio?'}}
+They are parsed without eval(): the canonical shape above is matched by a precompiled regex,
+anything else goes through ast.literal_eval, which only accepts literals.
+"""
+import re
+import ast
+
+# Lines that start with "Thought X:", "Action X:", or "Observation X:"
+STEP_PATTERN = re.compile(r'^(Thought|Action|Observation)\s+(\d+):', re.MULTILINE)
+# Lines that start with "Thought X:" or "Action X:", used to split combined reasoning steps
+THOUGHT_ACTION_PATTERN = re.compile(r'^(Thought|Action)\s+(\d+):', re.MULTILINE)
+FENCED_CODE_PATTERN = re.compile(r'```[^\n]*\n(.+?)```', re.DOTALL)
+INLINE_CODE_PATTERN = re.compile(r'`([^`]*)`', re.DOTALL)
+
+# {'function': 'name', 'parameters': {'key': 'value'}} with either quote style.
+# The value may contain escaped quotes and backslashes, but no other escape sequence and no
+# newline, so that the result is exactly what literal_eval would return; other values fall back to it.
+CANONICAL_ACTION_PATTERN = re.compile(
+    r"""\s*\{\s*(['"])function\1\s*:\s*(['"])(\w+)\2\s*,"""
+    r"""\s*(['"])parameters\4\s*:\s*\{\s*(['"])(\w+)\5\s*:\s*(['"])((?:(?!\7)[^\\\n]|\\[\\'"])*)\7\s*\}\s*\}\s*"""
+)
+ESCAPED_CHAR_PATTERN = re.compile(r"""\\([\\'"])""")
+
+def extract_code(text: str) -> str:
+    triple_match = FENCED_CODE_PATTERN.search(text)
+    if triple_match:
+        return triple_match.group(1)
+    single_match = INLINE_CODE_PATTERN.search(text)
+    if single_match:
+        return single_match.group(1)
+    return text
+
+def parse_action(text: str) -> dict:
+    """
+    Parse an action dict from its literal. Raise ValueError if it is not a dict
+    with 'function' and 'parameters' keys.
+    """
+    match = CANONICAL_ACTION_PATTERN.fullmatch(text)
+    if match:
+        value = match.group(8)
+        if '\\' in value:
+            value = ESCAPED_CHAR_PATTERN.sub(r'\1', value)
+        return {'function': match.group(3), 'parameters': {match.group(6): value}}
+
+    try:
+        action = ast.literal_eval(text.strip())
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError) as e:
+        raise ValueError(f"Action is not a valid dict literal: {e}") from None
+
+    if not isinstance(action, dict):
+        raise ValueError(f"Action is not a dict: {action}")
+    if "function" not in action:
+        raise ValueError(f"Action does not contain 'function' key: {action}")
+    if "parameters" not in action:
+        raise ValueError(f"Action does not contain 'parameters' key: {action}")
+    return action
+
+def parse_reasoning_steps(text: str, pattern=STEP_PATTERN):
+    """
+    Parse a string containing Thought/Action/Observation steps (including multi-line)
+    and return a list of dictionaries of the form:
+
+    [
+        {
+            "1": {
+                "Thought": "...",
+                "Action": "...",  # Only content inside backticks (if present)
+                "Observation": "..."
+            }
+        },
+        {
+            "2": {
+                "Thought": "...",
+                "Action": "...",
+                "Observation": "..."
+            }
+        },
+        ...
+    ]
+    """
+    # This dictionary will accumulate:
+    # data_dict[step_number] = {"Thought": ..., "Action": ..., "Observation": ...}
+    data_dict = {}
+
+    # We'll track the current label (Thought/Action/Observation) and step number
+    current_label = None
+    current_step = None
+    last_pos = 0
+
+    for match in pattern.finditer(text):
+        # If we already have a label in progress, we can record its content
+        if current_label is not None:
+            # Slice the text from the last match's end to the start of this new match
+            data_dict[current_step][current_label] = text[last_pos:match.start()].strip()
+
+        # Extract the new label and step, e.g. "Thought", "1"
+        label, step = match.group(1), match.group(2)
+
+        # Ensure a dict for this step
+        if step not in data_dict:
+            data_dict[step] = {"Thought": None, "Action": None, "Observation": None}
+
+        # Update current label/step, we'll slice from here next time
+        current_label = label
+        current_step = step
+        last_pos = match.end()
+
+    # Handle the final block after the last match
+    if current_label is not None:
+        data_dict[current_step][current_label] = text[last_pos:].strip()
+
+    # For each step, extract only the text inside triple backticks for "Action".
+    for step_number in data_dict:
+        action_text = data_dict[step_number]["Action"]
+        if action_text:
+            data_dict[step_number]["Action"] = extract_code(action_text)
+
+    # Convert our dictionary to the desired list-of-dicts structure
+    return [{step_number: data_dict[step_number]}
+            for step_number in sorted(data_dict.keys(), key=lambda x: int(x))]
@@ -1,13 +1,35 @@
-import requests
 from typing import List, Dict, Any, Union
 import copy
+import threading
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from termcolor import colored
 from src.prompts import rearag_system_prompt, short_ans_prompt, long_ans_prompt
-from src.utils import print_code
+from src.utils import print_code, normalize_answer, StreamingStepParser
+from src.http_client import get_http_client
+from src.endpoint_pool import get_endpoint_pool
+from src.conversation import ConversationBuffer, EpisodeState
+from src.cache import ObservationCache
+
+_observation_executor = None
+_observation_executor_lock = threading.Lock()
+
+def get_observation_executor(max_workers=64):
+    """
+    Thread pool shared by all agents of the process, used to fetch observations
+    (Search + Answer) in the background while the agent does something else.
+    """
+    global _observation_executor
+    if _observation_executor is None:
+        with _observation_executor_lock:
+            if _observation_executor is None:
+                _observation_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="observation")
+    return _observation_executor
 
 class ReaRAGAgent():
     def __init__(self, agent_api, tokenizer, allowed_actions, rag_engine, 
-                    iter_num_max, retry_max, agent_config, agent_utils):
+                    iter_num_max, retry_max, agent_config, agent_utils, latency_tracker=None):
         self.agent_api = agent_api
         self.tokenizer = tokenizer
         self.allowed_actions = allowed_actions
@@ -16,6 +38,10 @@ class ReaRAGAgent():
         self.retry_max = retry_max
         self.agent_config = agent_config
         self.agent_utils = agent_utils
+        self.latency_tracker = latency_tracker # Optional, records per-stage latency (see src.utils.LatencyTracker)
+        self.stop_event = None # Optional threading.Event, stops run() at the next iteration once set
+        self.episode_log = None # Optional src.episode_log.EpisodeLog, progress is saved after every iteration
+        self.episode_id = None
 
     def init_agent(self, question):
         """
@@ -23,48 +49,66 @@ class ReaRAGAgent():
         """
         self.question = question
 
-        self.conversation_chain = [
+        self.state = EpisodeState(ConversationBuffer(self.tokenizer, [
             {"role": "system", "content": rearag_system_prompt},
             {"role": "user", "content": question},
-        ]
-        self.reasoning_chain = [] # dict type: thought, action, observation
-        self.summary_chain = [] # str type:(question, answer)
+        ]))
         self.cur_iter_num = 1
+        self.retry_cnt = 0
+        self.votes = None # Answers of the trajectories, in self-consistency mode
+        self.fast_finished = False # The answer was returned without the short-answer generation
+        self.saved_checkpoint = None # State lengths at the last record of the episode log
+        self.saved_n_replaced = 0
+
+    @property
+    def conversation(self):
+        return self.state.conversation
+
+    @property
+    def conversation_chain(self):
+        return self.state.conversation.messages
+
+    @property
+    def summary_chain(self):
+        return self.state.summary_chain
+
+    @property
+    def reasoning_chain(self):
+        return self.state.reasoning_chain
 
     def run(self):
         """
         Infer single data: Given a question, interact with environment, then return the final answer
         """
         final_answer = None
-        retry_cnt = 0
         while self.cur_iter_num <= self.iter_num_max:
-            conv_backup = copy.deepcopy(self.conversation_chain)
-            summary_backup = copy.deepcopy(self.summary_chain)
-            reasoning_backup = copy.deepcopy(self.reasoning_chain)
-
-            # prompt = self.tokenizer.decode(self.agent_utils.tokenize_data(self.conversation_chain, self.system_prompt)['text'])
-            prompt = self.tokenizer.apply_chat_template(
-                self.conversation_chain,
-                add_special_tokens=False,
-                tokenize=False,  # Set True if you want tokenized result
-                add_generation_prompt=True  # Ensures correct format for model to continue generating
-            )
+            if self.stop_event is not None and self.stop_event.is_set():
+                break
+
+            # All chains are append-only within a step, so their lengths are enough to roll back
+            checkpoint = self.state.checkpoint()
+
+            # Replace old observations by their compact summary once the token budget is crossed
+            if self.agent_config.get("compaction", False):
+                self.compact_conversation()
+
+            # Only the messages appended since the last step are rendered and tokenized
+            prompt = self.conversation.prompt()
             
-            status, status_message =  self.step(prompt)
+            status, status_message =  self.step(prompt, num_tokens=self.conversation.num_tokens())
 
             if status == "repeat":
-                if retry_cnt < self.retry_max:
+                if self.retry_cnt < self.retry_max:
                     # Reset conversation_chain, summary_chain, reasoning_chain
-                    self.conversation_chain = copy.deepcopy(conv_backup) 
-                    self.summary_chain = copy.deepcopy(summary_backup)
-                    self.reasoning_chain = copy.deepcopy(reasoning_backup)
-                    retry_cnt += 1
+                    self.state.rollback(checkpoint)
+                    self.retry_cnt += 1
                     continue
                 else:
                     break
 
             elif status == "continue":
                 self.cur_iter_num += 1
+                self.save_progress()
         
             elif status == "finish":
                 final_answer = status_message
@@ -74,16 +118,110 @@ class ReaRAGAgent():
             # print_code(self.reasoning_chain)
 
         return final_answer
+
+    def save_progress(self):
+        """
+        Append the entries added since the last save to the episode log, if one is attached.
+        A full snapshot is written instead for the first save, and after compaction edited earlier messages.
+        """
+        if self.episode_log is None:
+            return
+        snapshot = self.saved_checkpoint is None or self.conversation.n_replaced != self.saved_n_replaced
+        since = (self.conversation.n_base, 0, 0, 0) if snapshot else self.saved_checkpoint
+        self.episode_log.append(self.episode_id, "snapshot" if snapshot else "delta",
+                                self.state.entries_since(since), self.cur_iter_num, self.retry_cnt)
+        self.saved_checkpoint = self.state.checkpoint()
+        self.saved_n_replaced = self.conversation.n_replaced
+
+    def resume(self, record):
+        """
+        Continue an episode saved in an episode log (see src.episode_log.EpisodeLog.load), after init_agent().
+        """
+        self.state.extend(record['entries'])
+        self.cur_iter_num = record['cur_iter_num']
+        self.retry_cnt = record['retry_cnt']
+        self.saved_checkpoint = self.state.checkpoint()
+        self.saved_n_replaced = self.conversation.n_replaced
+
+    def run_self_consistency(self, n_trajectories, quorum=None):
+        """
+        Self-consistency: run `n_trajectories` sampled trajectories of the question concurrently and return
+        the majority answer, compared after normalization (see src.utils.normalize_answer).
+        The trajectories share one observation cache, so common sub-queries are searched and answered once.
+        As soon as `quorum` trajectories (default: a majority) agree, the others stop at their next iteration.
+        The winning trajectory becomes the state of this agent, and the votes are kept in self.votes.
+        """
+        quorum = quorum or n_trajectories // 2 + 1
+
+        rag_engine = self.rag_engine
+        if rag_engine.observation_cache is None:
+            # Cache for the trajectories of this question only. It keeps the sampling config,
+            # greedy answers are only used when a deterministic cache was configured (--obs_cache_mode)
+            rag_engine = copy.copy(rag_engine)
+            rag_engine.observation_cache = ObservationCache(max_size=1024, deterministic=False)
+
+        stop_event = threading.Event()
+        trajectories = []
+        for _ in range(n_trajectories):
+            trajectory = type(self)(self.agent_api, self.tokenizer, self.allowed_actions, rag_engine, self.iter_num_max,
+                                    self.retry_max, self.agent_config, self.agent_utils, self.latency_tracker)
+            trajectory.init_agent(self.question)
+            trajectory.stop_event = stop_event
+            trajectories.append(trajectory)
+
+        votes = Counter()
+        first_answer = {} # normalized answer -> (answer, trajectory) of the first trajectory to give it
+        winner = None
+        executor = ThreadPoolExecutor(max_workers=n_trajectories, thread_name_prefix="trajectory")
+        try:
+            futures = {executor.submit(trajectory.run): trajectory for trajectory in trajectories}
+            for future in as_completed(futures):
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    print(colored(f"In run_self_consistency, trajectory failed: {e}", 'red'))
+                    continue
+                if not answer:
+                    continue
+
+                key = normalize_answer(answer) or answer.strip()
+                votes[key] += 1
+                first_answer.setdefault(key, (answer, futures[future]))
+                if votes[key] >= quorum:
+                    winner = key
+                    stop_event.set()
+                    break
+        finally:
+            # Stopped trajectories finish their current step in the background
+            executor.shutdown(wait=False)
+
+        if winner is None and votes:
+            winner = votes.most_common(1)[0][0]
+        self.votes = dict(votes)
+        if winner is None:
+            return None
+
+        answer, trajectory = first_answer[winner]
+        self.state = trajectory.state
+        self.cur_iter_num = trajectory.cur_iter_num
+        self.retry_cnt = trajectory.retry_cnt
+        self.fast_finished = trajectory.fast_finished
+        return answer
         
-    def step(self, prompt):
+    def step(self, prompt, num_tokens=None):
         """
         Perform one step to prompt the model one time.
         Next perform specific action based on the response, and return the result of action if exist
         """
 
         # (1) Get llm agent response
+        prefetched = None # Future of the first action's observation, only in streaming mode
         try:
-            agent_response = self.get_agent_response(prompt, self.agent_api)
+            with self.track("agent"):
+                if self.agent_config.get("stream", False):
+                    agent_response, prefetched = self.get_agent_response_stream(prompt, self.agent_api, num_tokens=num_tokens)
+                else:
+                    agent_response = self.get_agent_response(prompt, self.agent_api, num_tokens=num_tokens)
         except Exception as e:
             print(f"Error in get_agent_response: {e}")
             return "repeat", "Error in get_agent_response"
@@ -95,8 +233,11 @@ class ReaRAGAgent():
             print(f"Error in postprocess_agent_response: {e}")
             return "repeat", "Error in postprocess_agent_response"
 
+        # (3) Start fetching observations of the searches concurrently, they are still applied in order below
+        prefetched = self.dispatch_searches(actions, first_prefetched=prefetched)
+
         # (4) Perform the action
-        for thought, action in zip(thoughts, actions):
+        for idx, (thought, action) in enumerate(zip(thoughts, actions)):
             # (4.1) Check if the action is allowed
             action_type = action['function'] # Action is in the form of dict, {'function': '...', 'parameters': {'query': '...'}}
 
@@ -107,7 +248,8 @@ class ReaRAGAgent():
             if action_type == "search":
                 try:
                     self.handle_search_step(
-                        thought, action, agent_response
+                        thought, action, agent_response,
+                        prefetched=prefetched[idx]
                     )
                 except Exception as e:
                     print(f"Error in handle_search_step: {e}")
@@ -139,28 +281,55 @@ class ReaRAGAgent():
         return "continue", None
 
         
+    def dispatch_searches(self, actions, first_prefetched=None):
+        """
+        When one response contains several 'search' actions, fetch their observations concurrently,
+        so the turn takes max(search+answer) instead of the sum.
+        Only the searches before the first other action are dispatched, as a 'finish' depends on them.
+        The first search without a prefetched observation runs inline in the caller thread.
+        With `skip_seen_passages`, nothing is dispatched: the context of a search depends on the
+        passages shown by the previous ones, as in the serial path.
+
+        Return a list aligned with `actions`, holding a Future or None for each action.
+        """
+        prefetched = [None] * len(actions)
+        if actions:
+            prefetched[0] = first_prefetched
+        if not self.agent_config.get("parallel_search", True) or self.agent_config.get("skip_seen_passages", False):
+            return prefetched
+
+        inline_idx = None
+        for idx, action in enumerate(actions):
+            if action['function'] != "search" or "search" not in self.allowed_actions:
+                break
+            if prefetched[idx] is not None:
+                continue
+            if inline_idx is None:
+                inline_idx = idx
+            else:
+                prefetched[idx] = get_observation_executor().submit(self.fetch_observation, action, self.seen_snapshot())
+        return prefetched
+
     def handle_search_step(
         self,
         thought: str,
         action: Dict[str, Any],
         agent_response: str,
+        prefetched=None,
     ) -> None:
         """
         Handle a 'search' action within the RAG loop.
-        Update conversation, summary_chain, reasoning_chain in-place.
+        Update conversation, summary_chain, reasoning_chain and the passages already shown in-place.
+        `prefetched` is an optional Future of fetch_observation(action) that was started earlier.
         """
-        generation_config = {
-            'max_tokens': 1024,
-            'temperature': 0.95,
-            'top_p': 0.9,
-            'stop': ["<|user|>", "<|endoftext|>", "<|assistant|>"]
-        } # generation config for long answer
-
-        query = self.agent_utils.preprocess_query(action['parameters']['query'])
+        if prefetched is not None:
+            query, observation, shown = prefetched.result()
+        else:
+            query, observation, shown = self.fetch_observation(action, self.seen_snapshot())
 
-        # Call rag_engine
-        mem = self.rag_engine.Search(query)
-        observation = self.rag_engine.Answer(query, long_ans_prompt, generation_config, mem) # LongAnswer
+        # Recorded here, on the agent thread and in action order, so that a rollback of the step drops them
+        for key in shown:
+            self.state.seen_passages.add(key)
 
         # Store summary and reasoning chain
         self.summary_chain.append(f"{query}\n{observation}")
@@ -171,8 +340,38 @@ class ReaRAGAgent():
         })
 
         # Update conversation
-        self.conversation_chain.append({"role": "assistant", "content": agent_response})
-        self.conversation_chain.append({"role": "observation", "content": observation})
+        self.conversation.append({"role": "assistant", "content": agent_response})
+        self.conversation.append({"role": "observation", "content": observation})
+
+    def seen_snapshot(self):
+        """
+        Keys of the passages already shown in the episode, as an immutable copy that fetch_observation
+        can read from another thread. None if `skip_seen_passages` is disabled.
+        """
+        if not self.agent_config.get("skip_seen_passages", False):
+            return None
+        return frozenset(self.state.seen_passages.key_set)
+
+    def fetch_observation(self, action: Dict[str, Any], seen=None):
+        """
+        Call the rag engine for a 'search' action, without touching the agent state.
+        `seen` is a seen_snapshot() taken by the agent thread, passages in it are not shown again.
+        Return the preprocessed query, the observation and the keys of the passages it was generated from.
+        """
+        generation_config = {
+            'max_tokens': 1024,
+            'temperature': 0.95,
+            'top_p': 0.9,
+            'stop': ["<|user|>", "<|endoftext|>", "<|assistant|>"]
+        } # generation config for long answer
+
+        query = self.agent_utils.preprocess_query(action['parameters']['query'])
+
+        # Call rag_engine, LongAnswer
+        shown = []
+        observation = self.rag_engine.SearchAndAnswer(query, long_ans_prompt, generation_config, track=self.track,
+                                                      seen=seen, shown=shown if seen is not None else None)
+        return query, observation, shown
 
     def handle_finish_step(
         self, reference_ans: str
@@ -181,6 +380,13 @@ class ReaRAGAgent():
         Handle a 'finish' action in the RAG loop.
         Returns the final short answer.
         """
+        if self.agent_config.get("fast_finish", False):
+            with self.track("finish_check"):
+                supported = self.answer_is_supported(reference_ans)
+            if supported:
+                self.fast_finished = True
+                return reference_ans.strip()
+
         generation_config = {
             'max_tokens': 64,
             'temperature': 0.8,
@@ -197,42 +403,150 @@ class ReaRAGAgent():
             information_list.append(information)
         
         system = "You are a QA assistant. Always return a short answer. Output ONLY the answer with no extra words."
-        final_answer = self.rag_engine.Answer(self.question, short_ans_prompt, generation_config, information_list, system_msg=system)
+        with self.track("finish"):
+            final_answer = self.rag_engine.Answer(self.question, short_ans_prompt, generation_config, information_list, system_msg=system)
         return final_answer
+
+    def answer_is_supported(self, answer):
+        """
+        Whether the agent's own answer can be returned as is: it is at most `fast_finish_max_words` words,
+        and appears literally (after normalization) in the observations collected during the episode.
+        """
+        normalized = normalize_answer(answer)
+        if not normalized or len(normalized.split()) > self.agent_config.get("fast_finish_max_words", 5):
+            return False
+        observations = ' '.join(normalize_answer(str(reasoning['observation'])) for reasoning in self.reasoning_chain)
+        return f" {normalized} " in f" {observations} "
+
+    def track(self, stage):
+        """
+        Time a stage of the agent loop if a latency tracker is attached, otherwise do nothing.
+        """
+        if self.latency_tracker is None:
+            return nullcontext()
+        return self.latency_tracker.track(stage)
     
-    def get_agent_response(self, prompt, base_url):
+    def compact_conversation(self):
+        """
+        Bound the prompt length of long episodes without breaking the chat structure.
+        While the prompt exceeds `compaction_budget` tokens, the oldest observation turn is replaced by
+        a compact version of its entry in summary_chain, keeping the `compaction_keep_recent` latest
+        observations intact. The reasoning chain keeps the full observations for handle_finish_step.
+        If the prompt is still too long afterwards, prepare_prompt() falls back to truncation.
+        """
+        budget = self.agent_config.get("compaction_budget", self.agent_config["model_max_length"])
+        if self.conversation.num_tokens() <= budget:
+            return
+
+        max_tokens = self.agent_config.get("compact_obs_tokens", 64)
+        keep_recent = self.agent_config.get("compaction_keep_recent", 1)
+
+        # Every search appends one summary and one observation message, in the same order
+        obs_indices = [idx for idx, message in enumerate(self.conversation_chain) if message['role'] == "observation"]
+        n_compactable = max(0, min(len(obs_indices), len(self.summary_chain)) - keep_recent)
+
+        for k in range(n_compactable):
+            if self.conversation.num_tokens() <= budget:
+                break
+            observation = self.summary_chain[k].split('\n', 1)[-1]
+            compact = self.agent_utils.compact_observation(self.tokenizer, observation, max_tokens)
+            if len(compact) < len(self.conversation_chain[obs_indices[k]]['content']):
+                self.conversation.replace(obs_indices[k], {"role": "observation", "content": compact})
+
+    def prepare_prompt(self, prompt, num_tokens=None):
+        """
+        Truncate the prompt if it exceeds model_max_length.
+        `num_tokens` is the token count of `prompt` if already known, the prompt is only encoded when it is not.
+        """
         if self.agent_config["truncate"]:
-            tokens = self.tokenizer.encode(prompt, add_special_tokens=False)
-            if len(tokens)> self.agent_config["model_max_length"]:
-                print(f"Warning: Current prompt length: {len(tokens)},  exceeds model_max_length: {self.agent_config['model_max_length']}, truncating...")
+            if num_tokens is None:
+                num_tokens = len(self.tokenizer.encode(prompt, add_special_tokens=False))
+            if num_tokens > self.agent_config["model_max_length"]:
+                print(f"Warning: Current prompt length: {num_tokens},  exceeds model_max_length: {self.agent_config['model_max_length']}, truncating...")
+                tokens = self.tokenizer.encode(prompt, add_special_tokens=False)
                 prompt = self.agent_utils.truncate(self.tokenizer, tokens, self.agent_config["model_max_length"])
+        return prompt
+
+    def build_agent_request(self, prompt, stream=False):
+        return {
+            'inputs': prompt,
+            'stream': stream,
+            "parameters": {
+                "max_tokens": self.agent_config["max_tokens"],
+                "top_p": self.agent_config["top_p"],
+                "temperature": self.agent_config["temperature"],
+                "stop": self.agent_config["stop"],
+                "skip_special_tokens": False
+            }
+        }
 
+    def get_agent_response_stream(self, prompt, base_url, num_tokens=None):
+        """
+        Streaming variant of get_agent_response.
+        As soon as the fenced code of the first action is complete, a 'search' action is sent to the
+        rag engine in the background, so retrieval overlaps with the rest of the generation.
+        Only the first Thought/Action is kept, so generation is cancelled once the model starts another step.
+
+        Return:
+        - agent_response: str, cut before any extra step
+        - prefetched: Future of fetch_observation() for the first action, or None
+        """
+        prompt = self.prepare_prompt(prompt, num_tokens)
+        parser = StreamingStepParser()
+        prefetched = None
+        dispatched = False
+
+        payload = self.build_agent_request(prompt, stream=True)
+        stream = get_endpoint_pool(base_url).stream(lambda url: get_http_client().stream_json_lines(url, payload, timeout=360))
+        try:
+            for chunk in stream:
+                parser.feed(chunk['text'])
+                if not dispatched and parser.action_end is not None:
+                    dispatched = True
+                    prefetched = self.prefetch_observation(parser.first_step())
+                if parser.extra_start is not None:
+                    break # Closing the stream cancels the generation on the server
+        finally:
+            stream.close()
+
+        agent_response = parser.text
+        if parser.extra_start is not None:
+            agent_response = agent_response[:parser.extra_start]
+        return agent_response.strip(), prefetched
+
+    def prefetch_observation(self, step_text):
+        """
+        Start fetching the observation of a complete Thought/Action in the background.
+        Return a Future, or None if the action is not an allowed 'search'.
+        """
         try:
-            rep = requests.post(
-                base_url,
-                json={
-                    'inputs': prompt,
-                    'stream': False,
-                    "parameters": {
-                        "max_tokens": self.agent_config["max_tokens"],
-                        "top_p": self.agent_config["top_p"],
-                        "temperature": self.agent_config["temperature"],
-                        "stop": self.agent_config["stop"],
-                        "skip_special_tokens": False
-                    }
-                },
-                headers={
-                    'Content-Type': 'application/json'
-                },
-                timeout=360
-            )
+            _, actions = self.agent_utils.postprocess_agent_response(step_text)
+            action = actions[0]
+        except Exception:
+            return None # Let step() report the parsing error
+        if action['function'] != "search" or "search" not in self.allowed_actions:
+            return None
+        return get_observation_executor().submit(self.fetch_observation, action, self.seen_snapshot())
+
+    def get_agent_response(self, prompt, base_url, num_tokens=None):
+        prompt = self.prepare_prompt(prompt, num_tokens)
+
+        payload = self.build_agent_request(prompt)
+
+        def post(url):
+            rep = get_http_client().post_json(url, payload, timeout=360)
             rep.raise_for_status()  # <-- raises an HTTPError if status != 200
+            return rep
+
+        try:
+            # Balanced over the replicas of agent_api, fails over instead of burning a retry
+            rep = get_endpoint_pool(base_url).call(post)
 
         except Exception as e:
             print(f"Error in get_agent_response: {e}")
-            print(rep.text)
-            print("-----")
-            print(rep.json())
+            failed_rep = getattr(e, 'response', None)
+            if failed_rep is not None:
+                print(failed_rep.text)
             raise
         
         # If everything is OK:
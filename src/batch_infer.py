@@ -0,0 +1,158 @@
+"""
+Run ReaRAG over a whole dataset, keeping many agents in flight at once.
+
+Each question gets its own ReaRAGAgent, and all agents share one RAGEngine and tokenizers.
+Agents run on a thread pool, so while one agent waits on the retriever, others are
+generating. With the agent LLM served by deploy/vllm_async_serving.py (as deploy/deploy.sh does),
+the concurrent requests of different questions are batched together (continuous batching),
+so the servers stay busy instead of idling between the turns of a single agent.
+The synchronous deploy/vllm_serving.py does not support concurrent requests, run it with --num_workers 1.
+
+Input is a JSONL file where each line contains a `question` key (and optionally `id`, `answer`).
+Results are appended to the output JSONL file as soon as each question finishes.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+from src.infer import build_rag_engine, build_agent, add_common_args, setup_http_client
+from src.tokenizer_registry import get_tokenizer
+from src.utils import LatencyTracker, read_jsonl, append_jsonl
+from src.endpoint_pool import all_endpoint_pools
+from src.episode_log import EpisodeLog
+
+def load_completed_ids(filepath):
+    """Return ids of questions already written to the output file."""
+    if not os.path.exists(filepath):
+        return set()
+    return {str(item['id']) for item in read_jsonl(filepath)}
+
+def run_question(item, rearag_tokenizer, rag_engine, args, latency_tracker, episode_log=None, saved_episode=None):
+    agent = build_agent(args, rearag_tokenizer, rag_engine, latency_tracker=latency_tracker)
+    agent.init_agent(item['question'])
+    if episode_log is not None:
+        agent.episode_log = episode_log
+        agent.episode_id = item['id']
+        if saved_episode is not None:
+            agent.resume(saved_episode) # Continue from the last saved iteration
+
+    start = time.perf_counter()
+    error = None
+    final_answer = None
+    try:
+        if args.n_trajectories > 1:
+            final_answer = agent.run_self_consistency(args.n_trajectories, args.quorum)
+        else:
+            final_answer = agent.run()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+    latency_tracker.add("question", elapsed)
+
+    return {
+        "id": item['id'],
+        "question": item['question'],
+        "answer": item.get('answer'),
+        "prediction": final_answer.strip() if final_answer else None,
+        "reasoning_chain": agent.reasoning_chain,
+        "num_iters": agent.cur_iter_num,
+        "votes": agent.votes,
+        "fast_finish": agent.fast_finished,
+        "latency": elapsed,
+        "error": error,
+    }
+
+def main(args):
+    data = read_jsonl(args.input_file)
+    for idx, item in enumerate(data):
+        item['id'] = str(item.get('id', idx))
+    if args.n_sample > 0:
+        data = data[:args.n_sample]
+
+    # Skip questions that were answered in a previous run
+    completed_ids = load_completed_ids(args.output_file)
+    data = [item for item in data if item['id'] not in completed_ids]
+    print(f"Questions to process: {len(data)} (skipped {len(completed_ids)} already completed)")
+
+    # Keep one keep-alive connection per in-flight agent to each server
+    http_client = setup_http_client(args, pool_maxsize=args.num_workers,
+                                    max_concurrency_per_endpoint=args.endpoint_concurrency)
+
+    # Loaded in the background while the rest is set up, shared if both paths are the same
+    rearag_tokenizer = get_tokenizer(args.rearag_tokenizer_path).prefetch()
+    ans_tokenizer = get_tokenizer(args.ans_tokenizer_path).prefetch()
+    latency_tracker = LatencyTracker()
+    rag_engine = build_rag_engine(args, ans_tokenizer, latency_tracker=latency_tracker)
+
+    # Episodes interrupted by a previous run resume from their last saved iteration
+    episode_log, saved_episodes = None, {}
+    if args.episode_log is not None:
+        saved_episodes = EpisodeLog.load(args.episode_log)
+        episode_log = EpisodeLog(args.episode_log)
+        n_resumed = sum(item['id'] in saved_episodes for item in data)
+        print(f"Resuming {n_resumed} questions from {args.episode_log}")
+
+    n_done, n_failed, n_fast = 0, 0, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor, \
+            open(args.output_file, 'a', encoding='utf-8') as f_out:
+        futures = [
+            executor.submit(run_question, item, rearag_tokenizer, rag_engine, args, latency_tracker,
+                            episode_log, saved_episodes.get(item['id']))
+            for item in data
+        ]
+
+        pbar = tqdm(as_completed(futures), total=len(futures), desc="ReaRAG inference")
+        for future in pbar:
+            result = future.result()
+            append_jsonl(f_out, result)
+            if episode_log is not None:
+                episode_log.done(result['id'])
+
+            n_done += 1
+            n_failed += result['prediction'] is None
+            n_fast += result['fast_finish']
+            pbar.set_postfix(qps=f"{n_done / (time.perf_counter() - start):.2f}", failed=n_failed)
+
+    elapsed = time.perf_counter() - start
+    print(f"Finished {n_done} questions in {elapsed:.1f}s, {n_done / max(elapsed, 1e-9):.2f} questions/sec, {n_failed} without answer")
+    latency_tracker.print_summary()
+    if args.fast_finish:
+        # Estimated with the mean latency of the short-answer generations that did run
+        finish = latency_tracker.summary().get('finish')
+        saved = f"~{n_fast * finish['mean']:.1f}s" if finish else "n/a"
+        print(f"Fast finish: {n_fast}/{n_done} answers returned without short-answer generation, {saved} of generation saved")
+    if rag_engine.search_batcher is not None:
+        print(f"Search batching: {rag_engine.search_batcher.stats()}")
+    if rag_engine.single_flight is not None:
+        print(f"Coalesced requests: {rag_engine.single_flight.stats()}")
+    if rag_engine.observation_cache is not None:
+        print(f"Observation cache: {rag_engine.observation_cache.stats()}")
+    for urls, pool in all_endpoint_pools().items():
+        if len(urls) > 1:
+            print(f"Endpoint pool: {pool.stats()}")
+    print(f"Results saved at {args.output_file}")
+    if episode_log is not None:
+        episode_log.close()
+    http_client.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='ReaRAG batch inference')
+    add_common_args(parser)
+    parser.add_argument('--input_file', type=str,
+                        required=True, help="JSONL file, each line contains a `question` key")
+    parser.add_argument('--output_file', type=str,
+                        required=True, help="JSONL file to append results to")
+    parser.add_argument('--num_workers', type=int, default=128,
+                        help="number of agents in flight at once. Above 1, requires vllm_async_serving.py for agent_api")
+    parser.add_argument('--endpoint_concurrency', type=int, default=None,
+                        help="max in-flight requests per server, default unlimited")
+    parser.add_argument('--episode_log', type=str, default=None,
+                        help="append-only log of every agent's progress, a restarted run resumes unfinished questions from it")
+    parser.add_argument('--n_sample', type=int, default=-1,
+                        help="number of questions to run, -1 means all")
+    args = parser.parse_args()
+
+    main(args)
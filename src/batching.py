@@ -0,0 +1,68 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class MicroBatcher():
+    def __init__(self, batch_fn, max_batch_size=32, max_wait_ms=5, max_inflight_batches=4):
+        """
+        Gather items submitted concurrently by many threads into batches.
+        A batch is dispatched when it reaches `max_batch_size` items, or `max_wait_ms` after its first item arrived.
+        Parameters:
+        - batch_fn: Callable taking a list of items and returning the list of their results, in the same order.
+        - max_batch_size: Maximum number of items per batch.
+        - max_wait_ms: Maximum time the first item of a batch waits for others.
+        - max_inflight_batches: Number of batches that can be processed at the same time.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max_inflight_batches, thread_name_prefix="micro_batch")
+        self.n_items = 0
+        self.n_batches = 0
+
+        self.thread = threading.Thread(target=self._collect, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """Return a Future of the result of `item`."""
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def _collect(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.n_items += len(batch)
+            self.n_batches += 1
+            self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.batch_fn(items)
+            assert len(results) == len(items), f"Batch of {len(items)} items returned {len(results)} results"
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        return {
+            'items': self.n_items,
+            'batches': self.n_batches,
+            'avg_batch_size': self.n_items / self.n_batches if self.n_batches else 0.0,
+        }
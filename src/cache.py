@@ -0,0 +1,141 @@
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+def normalize_query(query):
+    """Lowercase, collapse whitespace and drop surrounding punctuation, so trivial variants share an entry."""
+    query = ' '.join(query.lower().split())
+    return re.sub(r'^[\W_]+|[\W_]+$', '', query) or query
+
+class ObservationCache():
+    def __init__(self, max_size=10000, disk_path=None, deterministic=True, fingerprint=None):
+        """
+        Cache of observations (Search + long Answer) shared across agents and episodes.
+        Entries are keyed by normalized query, top_k and prompt template, within a namespace of the
+        generation mode and `fingerprint`, so a persistent file is not reused across configurations.
+        Parameters:
+        - max_size: Maximum number of entries kept in memory, least recently used entries are evicted first.
+        - disk_path: Optional sqlite file used as a second tier, which persists across runs.
+        - deterministic: If True, answers are generated greedily (temperature 0), so a cached
+          observation is exactly what a fresh call would return. If False, the sampling config
+          is kept and the first sampled answer is reused for later hits.
+        - fingerprint: JSON-serializable description of what produces the observations, e.g. the
+          answer model and the context token budget. Entries written under another fingerprint are not served.
+        """
+        self.max_size = max_size
+        self.deterministic = deterministic
+        namespace = json.dumps([deterministic, fingerprint], sort_keys=True, ensure_ascii=False)
+        self.namespace = hashlib.sha1(namespace.encode('utf-8')).hexdigest()[:16]
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.db = None
+        if disk_path is not None:
+            self.db = sqlite3.connect(disk_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS observations (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.commit()
+
+    def make_key(self, query, top_k, prompt_template):
+        template_hash = hashlib.sha1(prompt_template.encode('utf-8')).hexdigest()[:16]
+        return json.dumps([self.namespace, normalize_query(query), top_k, template_hash], ensure_ascii=False)
+
+    def generation_config(self, generation_config):
+        """Generation config to use for answers that will be cached."""
+        if self.deterministic:
+            return {**generation_config, 'temperature': 0.0}
+        return generation_config
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT value FROM observations WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._put_memory(key, row[0])
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self._put_memory(key, value)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO observations (key, value) VALUES (?, ?)", (key, value))
+                self.db.commit()
+
+    def _put_memory(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'size': len(self.entries),
+            }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+class SingleFlight():
+    """
+    Coalesce concurrent identical calls: while a call for a key is in flight, later callers with
+    the same key wait for it and share its result (or exception) instead of calling upstream again.
+    Unlike ObservationCache nothing is kept once the call completes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.calls = 0
+        self.saved = 0
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the identical call already in flight."""
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+                self.calls += 1
+            else:
+                self.saved += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'saved': self.saved}
@@ -0,0 +1,147 @@
+"""
+Record/replay of the remote calls of the agent loop (agent LLM, retriever and answer LLM).
+
+In record mode, every request sent through the shared HTTP client is forwarded to the real
+servers and the response is appended to a JSONL cassette. In replay mode, responses are served
+from the cassette without any server, optionally sleeping for the recorded or a synthetic latency.
+This lets the agent loop (templating, parsing, state handling) be profiled offline.
+
+Requests are keyed by the logical endpoint (the URL path, e.g. /generate or /search, not the
+replica that served it) and canonical JSON payload, so replicas picked by load balancing
+replay the same way. Identical requests are replayed in the order they were recorded.
+Requests whose grouping or number depends on timing (batched searches, hedged requests) cannot
+be replayed deterministically, setup_http_client rejects them with a cassette.
+"""
+import json
+import time
+import hashlib
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+
+class CassetteMiss(Exception):
+    pass
+
+def request_key(url, payload):
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(f"{urlsplit(url).path}\n{canonical}".encode('utf-8')).hexdigest()
+
+def build_response(url, status_code, body):
+    rep = requests.Response()
+    rep.url = url
+    rep.status_code = status_code
+    rep._content = body.encode('utf-8')
+    rep.encoding = 'utf-8'
+    return rep
+
+class CassetteClient():
+    def __init__(self, path, mode="replay", client=None, latency="recorded"):
+        """
+        Drop-in replacement of src.http_client.HTTPClient.
+        Parameters:
+        - path: JSONL cassette file.
+        - mode: "record" forwards requests to `client` and appends them to the cassette,
+                "replay" serves them from the cassette.
+        - client: Real HTTPClient, required in record mode.
+        - latency: Replay only. "recorded" sleeps for the recorded latency, "none" does not sleep,
+                   a number sleeps for that many seconds per request (synthetic latency).
+        """
+        assert mode in ("record", "replay"), f"Unknown cassette mode: {mode}"
+        assert mode == "replay" or client is not None, "A real client is required to record"
+        self.path = path
+        self.mode = mode
+        self.client = client
+        self.latency = latency
+        self.lock = threading.Lock()
+
+        if mode == "record":
+            self.f_out = open(path, 'a', encoding='utf-8')
+        else:
+            self.entries = defaultdict(list)
+            self.cursors = defaultdict(int)
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['key']].append(entry)
+
+    def _write(self, entry):
+        with self.lock:
+            self.f_out.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.f_out.flush()
+
+    def _next_entry(self, url, payload):
+        key = request_key(url, payload)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise CassetteMiss(f"No recorded response for request to {url}")
+            # Identical requests get the recorded responses in order, the last one is repeated
+            idx = min(self.cursors[key], len(entries) - 1)
+            self.cursors[key] += 1
+        return entries[idx]
+
+    def _sleep(self, recorded_seconds):
+        if self.latency == "recorded":
+            time.sleep(recorded_seconds)
+        elif self.latency != "none":
+            time.sleep(float(self.latency))
+
+    def post_json(self, url, payload, timeout=360):
+        if self.mode == "record":
+            start = time.perf_counter()
+            rep = self.client.post_json(url, payload, timeout=timeout)
+            self._write({
+                'key': request_key(url, payload),
+                'url': url,
+                'status_code': rep.status_code,
+                'body': rep.text,
+                'latency': time.perf_counter() - start,
+            })
+            return rep
+
+        entry = self._next_entry(url, payload)
+        self._sleep(entry['latency'])
+        return build_response(url, entry['status_code'], entry['body'])
+
+    def stream_json_lines(self, url, payload, timeout=360):
+        if self.mode == "record":
+            start = time.perf_counter()
+            lines, offsets = [], []
+            try:
+                for line in self.client.stream_json_lines(url, payload, timeout=timeout):
+                    lines.append(line)
+                    offsets.append(time.perf_counter() - start)
+                    yield line
+            finally:
+                # Also record streams closed early by the consumer, they are replayed up to the same point
+                self._write({
+                    'key': request_key(url, payload),
+                    'url': url,
+                    'lines': lines,
+                    'offsets': offsets,
+                })
+            return
+
+        entry = self._next_entry(url, payload)
+        if self.latency not in ("recorded", "none"):
+            time.sleep(float(self.latency)) # Synthetic latency is paid once per stream
+        previous = 0.0
+        for line, offset in zip(entry['lines'], entry['offsets']):
+            if self.latency == "recorded":
+                time.sleep(offset - previous)
+                previous = offset
+            yield line
+
+    def get(self, url, timeout=10):
+        if self.mode == "record":
+            return self.client.get(url, timeout=timeout)
+        return build_response(url, 200, "{}")
+
+    def close(self):
+        if self.mode == "record":
+            self.f_out.close()
+        if self.client is not None:
+            self.client.close()
@@ -0,0 +1,211 @@
+class ConversationBuffer():
+    def __init__(self, tokenizer, messages):
+        """
+        Conversation chain that renders the chat template incrementally.
+
+        The initial messages (system prompt and question) are rendered once. Every appended
+        message is rendered on its own, as the difference between rendering
+        `initial + [message]` and rendering `initial`, and its token ids are cached. The prompt
+        is then the concatenation of the cached pieces, and the token count is kept as a
+        running prefix sum, so the per-step cost does not grow with the length of the chain.
+
+        Templates that do not render messages independently of their position are detected
+        on the second appended message, and the buffer falls back to full re-rendering.
+
+        Parameters:
+        - tokenizer: HF tokenizer with a chat template.
+        - messages: Initial messages, e.g. [{"role": "system", ...}, {"role": "user", ...}].
+        """
+        self.tokenizer = tokenizer
+        self.messages = list(messages)
+        self.n_base = len(self.messages)
+        self.n_replaced = 0 # Number of replace() calls, i.e. edits of earlier messages
+        self.incremental = True
+
+        self.base_text = self.render(self.messages)
+        self.base_ids = self.encode(self.base_text)
+        generation_text = self.render(self.messages, add_generation_prompt=True)
+        if generation_text.startswith(self.base_text):
+            self.generation_suffix = generation_text[len(self.base_text):]
+        else:
+            self.generation_suffix = None
+            self.incremental = False
+        self.generation_ids = self.encode(self.generation_suffix or "")
+
+        # Per appended message: rendered text and token ids.
+        # prefix_tokens[i] is the number of tokens of the base plus the first i appended messages.
+        self.texts = []
+        self.token_ids = []
+        self.prefix_tokens = [len(self.base_ids)]
+
+    def render(self, messages, add_generation_prompt=False):
+        return self.tokenizer.apply_chat_template(
+            messages,
+            add_special_tokens=False,
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt
+        )
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def append(self, message):
+        self.messages.append(message)
+        if not self.incremental:
+            return
+
+        text = self.render(self.messages[:self.n_base] + [message])
+        if not text.startswith(self.base_text):
+            self.incremental = False
+            return
+        text = text[len(self.base_text):]
+        ids = self.encode(text)
+
+        self.texts.append(text)
+        self.token_ids.append(ids)
+        self.prefix_tokens.append(self.prefix_tokens[-1] + len(ids))
+
+        # Verify once that pieces rendered in isolation match the full rendering
+        if len(self.texts) == 2 and self.render(self.messages) != self.base_text + ''.join(self.texts):
+            self.incremental = False
+
+    def replace(self, index, message):
+        """
+        Replace an appended message, e.g. with a compacted version.
+        Only this message is re-rendered, the running token counts after it are shifted.
+        """
+        assert index >= self.n_base, "The initial messages cannot be replaced"
+        self.messages[index] = message
+        self.n_replaced += 1
+        if not self.incremental:
+            return
+
+        text = self.render(self.messages[:self.n_base] + [message])
+        if not text.startswith(self.base_text):
+            self.incremental = False
+            return
+        text = text[len(self.base_text):]
+        ids = self.encode(text)
+
+        i = index - self.n_base
+        delta = len(ids) - len(self.token_ids[i])
+        self.texts[i] = text
+        self.token_ids[i] = ids
+        for j in range(i + 1, len(self.prefix_tokens)):
+            self.prefix_tokens[j] += delta
+
+    def truncate(self, n_messages):
+        """
+        Drop every message after the first `n_messages`, the initial messages are always kept.
+        """
+        n_messages = max(n_messages, self.n_base)
+        del self.messages[n_messages:]
+        n_appended = n_messages - self.n_base
+        del self.texts[n_appended:]
+        del self.token_ids[n_appended:]
+        del self.prefix_tokens[n_appended + 1:]
+
+    def prompt(self):
+        """
+        Rendered conversation followed by the generation prompt, same as
+        `apply_chat_template(messages, tokenize=False, add_generation_prompt=True)`.
+        """
+        if not self.incremental:
+            return self.render(self.messages, add_generation_prompt=True)
+        return self.base_text + ''.join(self.texts) + self.generation_suffix
+
+    def num_tokens(self):
+        """
+        Number of tokens of `prompt()`. Pieces are tokenized separately, which matches
+        tokenizing the whole prompt as long as pieces are delimited by special tokens,
+        as they are in chat templates.
+        """
+        if not self.incremental:
+            return len(self.encode(self.prompt()))
+        return self.prefix_tokens[-1] + len(self.generation_ids)
+
+    def prompt_token_ids(self):
+        if not self.incremental:
+            return self.encode(self.prompt())
+        ids = list(self.base_ids)
+        for piece in self.token_ids:
+            ids.extend(piece)
+        ids.extend(self.generation_ids)
+        return ids
+
+class PassageJournal():
+    """
+    Keys of the passages shown to the answer model during an episode.
+    Append-only, so it can be rolled back with the other chains of the episode.
+    """
+    def __init__(self):
+        self.keys = []
+        self.key_set = set()
+
+    def __contains__(self, key):
+        return key in self.key_set
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        if key not in self.key_set:
+            self.key_set.add(key)
+            self.keys.append(key)
+
+    def truncate(self, n_keys):
+        for key in self.keys[n_keys:]:
+            self.key_set.discard(key)
+        del self.keys[n_keys:]
+
+class EpisodeState():
+    def __init__(self, conversation):
+        """
+        State of one agent episode: conversation, summary chain, reasoning chain and the passages already shown.
+
+        All of them are append-only within a step, so a checkpoint is just their lengths, and
+        rolling back to it drops the entries appended since, without copying any message body.
+
+        Parameters:
+        - conversation: ConversationBuffer holding the conversation chain.
+        """
+        self.conversation = conversation
+        self.summary_chain = [] # str type:(question, answer)
+        self.reasoning_chain = [] # dict type: thought, action, observation
+        self.seen_passages = PassageJournal() # passages already shown to the answer model
+
+    def checkpoint(self):
+        return (len(self.conversation), len(self.summary_chain), len(self.reasoning_chain), len(self.seen_passages))
+
+    def rollback(self, checkpoint):
+        conv_len, summary_len, reasoning_len, seen_len = checkpoint
+        self.conversation.truncate(conv_len)
+        del self.summary_chain[summary_len:]
+        del self.reasoning_chain[reasoning_len:]
+        self.seen_passages.truncate(seen_len)
+
+    def entries_since(self, checkpoint):
+        """
+        Entries appended since `checkpoint`, e.g. to save the progress of the episode.
+        """
+        conv_len, summary_len, reasoning_len, seen_len = checkpoint
+        return {
+            'messages': self.conversation.messages[conv_len:],
+            'summary_chain': self.summary_chain[summary_len:],
+            'reasoning_chain': self.reasoning_chain[reasoning_len:],
+            'seen_passages': self.seen_passages.keys[seen_len:],
+        }
+
+    def extend(self, entries):
+        """
+        Append entries returned by entries_since(), e.g. to restore a saved episode.
+        """
+        for message in entries['messages']:
+            self.conversation.append(message)
+        self.summary_chain.extend(entries['summary_chain'])
+        self.reasoning_chain.extend(entries['reasoning_chain'])
+        for key in entries['seen_passages']:
+            self.seen_passages.add(key)
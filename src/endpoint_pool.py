@@ -0,0 +1,280 @@
+"""
+Load balancing and failover over replicas of the same server (agent LLM, retriever or answer LLM).
+
+Everywhere a single URL was accepted (`agent_api`, `retriever_api`, `generation_api`), a
+comma-separated list of URLs, or a list, can be given instead. Requests then go through the
+process-wide EndpointPool of those URLs:
+- least-outstanding-requests balancing, so a slow replica receives less traffic;
+- failover to another replica on connection errors, timeouts and 5xx responses;
+- a circuit breaker, which takes a replica out of rotation for `cooldown_s` after
+  `failure_threshold` consecutive failures;
+- optional health checking against the `/health` route of the servers (replicas answering 404 are
+  not health checked, only the circuit breaker applies to them);
+- optional hedged requests: if a request is not done after `hedge_after_ms`, the same request is
+  sent to a second replica and the first response wins.
+
+Use `get_endpoint_pool(spec)` to obtain the pool of a spec, and `configure_endpoint_pools()` to set
+the options of the pools created afterwards.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from termcolor import colored
+
+from src.http_client import get_http_client, endpoint_key
+
+def parse_endpoints(spec):
+    """A URL, a comma-separated string of URLs, or a list of URLs."""
+    if isinstance(spec, str):
+        spec = spec.split(',')
+    return [url.strip() for url in spec if url.strip()]
+
+def is_endpoint_failure(e):
+    """Errors that say something about the replica. 4xx responses are the caller's fault and are not retried."""
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout, OSError))
+
+class Endpoint():
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0 # Circuit is open (replica skipped) until this time
+        self.healthy = True
+        self.n_requests = 0
+        self.n_failures = 0
+
+class EndpointPool():
+    def __init__(self, urls, failure_threshold=3, cooldown_s=30, hedge_after_ms=None, health_interval_s=None, max_in_flight=64):
+        """
+        Parameters:
+        - urls: URLs of the replicas, all serving the same route.
+        - failure_threshold: Consecutive failures after which the circuit of a replica opens.
+        - cooldown_s: Time a replica stays out of rotation once its circuit opened.
+        - hedge_after_ms: Send a second copy of a request still running after that long, None disables hedging.
+        - health_interval_s: Poll `/health` of every replica at this interval, None disables health checking.
+        - max_in_flight: Concurrent callers of the pool, sizes the threads running hedged requests (a primary
+          and a backup each) so that requests are not queued behind each other.
+        """
+        assert urls, "An endpoint pool needs at least one URL"
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.failure_threshold = failure_threshold
+        self.cooldown_s = cooldown_s
+        self.hedge_after = hedge_after_ms / 1000 if hedge_after_ms else None
+        self.lock = threading.Lock()
+        self.n_hedges = 0
+        self.n_hedge_wins = 0
+
+        self.executor = None
+        if self.hedge_after is not None and len(self.endpoints) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=2 * max_in_flight, thread_name_prefix="hedged_request")
+
+        if health_interval_s is not None:
+            self.health_interval = health_interval_s
+            threading.Thread(target=self._health_loop, daemon=True).start()
+
+    def acquire(self, exclude=()):
+        """
+        Pick the replica with the fewest outstanding requests among those that are healthy and
+        whose circuit is closed. If there is none, fall back to any replica rather than failing.
+        Return None if every replica is excluded.
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [ep for ep in self.endpoints if ep not in exclude]
+            if not candidates:
+                return None
+            available = [ep for ep in candidates if ep.healthy and ep.open_until <= now]
+            endpoint = min(available or candidates, key=lambda ep: (ep.outstanding, ep.n_requests))
+            endpoint.outstanding += 1
+            endpoint.n_requests += 1
+            return endpoint
+
+    def release(self, endpoint, failed=False):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.n_failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.open_until = time.monotonic() + self.cooldown_s
+                print(colored(f"Endpoint {endpoint.url} failed {endpoint.consecutive_failures} times in a row, "
+                              f"skipping it for {self.cooldown_s}s", 'yellow'))
+
+    def _attempt(self, fn, endpoint):
+        failed = False
+        try:
+            return fn(endpoint.url)
+        except Exception as e:
+            failed = is_endpoint_failure(e)
+            raise
+        finally:
+            self.release(endpoint, failed)
+
+    def call(self, fn):
+        """
+        Return `fn(url)` for the URL of a replica; `fn` should raise on a bad response status.
+        On an endpoint failure the call is retried on each other replica once.
+        """
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried)
+            tried.append(endpoint)
+            try:
+                if self.executor is not None:
+                    return self._hedged_call(fn, endpoint, tried)
+                return self._attempt(fn, endpoint)
+            except Exception as e:
+                if not is_endpoint_failure(e) or len(tried) >= len(self.endpoints):
+                    raise
+                print(colored(f"Endpoint {endpoint.url} failed ({e}), retrying on another replica", 'yellow'))
+
+    def _hedged_call(self, fn, endpoint, tried):
+        started = threading.Event()
+        def attempt_primary():
+            started.set()
+            return self._attempt(fn, endpoint)
+
+        primary = self.executor.submit(attempt_primary)
+        # The hedge delay counts from when the request is sent, time queued for a thread is not the replica's fault
+        started.wait()
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        backup_endpoint = self.acquire(exclude=tried)
+        if backup_endpoint is None:
+            return primary.result()
+        tried.append(backup_endpoint)
+        with self.lock:
+            self.n_hedges += 1
+        backup = self.executor.submit(self._attempt, fn, backup_endpoint)
+
+        # First successful response wins, the other request completes in the background
+        pending = {primary, backup}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        with self.lock:
+                            self.n_hedge_wins += 1
+                    return future.result()
+        return primary.result() # Both failed, raise the error of the primary
+
+    def stream(self, fn):
+        """
+        Yield from `fn(url)` for the URL of a replica, e.g. HTTPClient.stream_json_lines.
+        Fails over to another replica only if nothing was received yet. Streams are not hedged.
+        """
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried)
+            tried.append(endpoint)
+            started = False
+            failed = False
+            items = fn(endpoint.url)
+            try:
+                for item in items:
+                    started = True
+                    yield item
+                return
+            except GeneratorExit:
+                raise # Closed by the consumer
+            except Exception as e:
+                failed = is_endpoint_failure(e)
+                if not failed or started or len(tried) >= len(self.endpoints):
+                    raise
+                print(colored(f"Endpoint {endpoint.url} failed ({e}), retrying on another replica", 'yellow'))
+            finally:
+                items.close() # Closing the stream early cancels the request on the server
+                self.release(endpoint, failed)
+
+    async def astream(self, fn):
+        """
+        asyncio counterpart of stream, `fn(url)` returns an async iterator.
+        """
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried)
+            tried.append(endpoint)
+            started = False
+            failed = False
+            items = fn(endpoint.url)
+            try:
+                async for item in items:
+                    started = True
+                    yield item
+                return
+            except GeneratorExit:
+                raise
+            except Exception as e:
+                failed = is_endpoint_failure(e) or type(e).__module__.startswith('aiohttp')
+                if not failed or started or len(tried) >= len(self.endpoints):
+                    raise
+                print(colored(f"Endpoint {endpoint.url} failed ({e}), retrying on another replica", 'yellow'))
+            finally:
+                await items.aclose()
+                self.release(endpoint, failed)
+
+    def _health_loop(self):
+        unprobed = set() # Replicas without a /health route, left to the circuit breaker
+        while True:
+            for endpoint in self.endpoints:
+                if endpoint in unprobed:
+                    continue
+                try:
+                    status_code = get_http_client().get(f"{endpoint_key(endpoint.url)}/health", timeout=5).status_code
+                except Exception:
+                    status_code = None
+                if status_code in (404, 405):
+                    print(colored(f"Endpoint {endpoint.url} has no /health route, health checking is disabled for it", 'yellow'))
+                    unprobed.add(endpoint)
+                    endpoint.healthy = True
+                    continue
+                healthy = status_code == 200
+                if endpoint.healthy and not healthy:
+                    print(colored(f"Endpoint {endpoint.url} is unhealthy", 'yellow'))
+                endpoint.healthy = healthy
+            if len(unprobed) == len(self.endpoints):
+                return
+            time.sleep(self.health_interval)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'endpoints': {
+                    ep.url: {'requests': ep.n_requests, 'failures': ep.n_failures, 'outstanding': ep.outstanding,
+                             'healthy': ep.healthy, 'circuit_open': ep.open_until > time.monotonic()}
+                    for ep in self.endpoints
+                },
+                'hedges': self.n_hedges,
+                'hedge_wins': self.n_hedge_wins,
+            }
+
+_pools = {}
+_pool_options = {}
+_pools_lock = threading.Lock()
+
+def configure_endpoint_pools(**options):
+    """Set the EndpointPool options (failure_threshold, cooldown_s, ...) of the pools created afterwards."""
+    _pool_options.update(options)
+
+def get_endpoint_pool(spec):
+    """Return the process-wide EndpointPool of `spec`, shared by all agents and engines using it."""
+    if isinstance(spec, EndpointPool):
+        return spec
+    urls = tuple(parse_endpoints(spec))
+    with _pools_lock:
+        if urls not in _pools:
+            _pools[urls] = EndpointPool(list(urls), **_pool_options)
+        return _pools[urls]
+
+def all_endpoint_pools():
+    with _pools_lock:
+        return dict(_pools)
@@ -0,0 +1,82 @@
+"""
+Append-only log of the progress of agent episodes, so that a restarted batch run resumes
+in-progress questions mid-episode instead of redoing the turns already done.
+
+Every line is one JSON record:
+- {"id", "type": "delta", "entries", "cur_iter_num", "retry_cnt"}: entries appended since the
+  previous record of the episode (see EpisodeState.entries_since).
+- {"id", "type": "snapshot", ...}: all entries of the episode. Written for the first record, and
+  whenever earlier messages were edited (compaction), which a delta cannot express.
+- {"id", "type": "done"}: the episode finished, its result is in the output file.
+
+A line cut by a crash is ignored, the episode then resumes from its previous record.
+"""
+import os
+import json
+import threading
+
+class EpisodeLog():
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f_out = open(path, 'a', encoding='utf-8')
+        # Terminate a line cut by a crash, so that it does not swallow the next record
+        if os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.f_out.write('\n')
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.f_out.write(line)
+            self.f_out.flush()
+
+    def append(self, episode_id, record_type, entries, cur_iter_num, retry_cnt):
+        self._write({
+            'id': episode_id,
+            'type': record_type,
+            'entries': entries,
+            'cur_iter_num': cur_iter_num,
+            'retry_cnt': retry_cnt,
+        })
+
+    def done(self, episode_id):
+        self._write({'id': episode_id, 'type': 'done'})
+
+    @staticmethod
+    def load(path):
+        """
+        Replay the log, return {episode_id: record} of the episodes that did not finish, where
+        record holds all their entries, their cur_iter_num and retry_cnt.
+        """
+        episodes = {}
+        try:
+            f = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return episodes
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # Line cut by a crash
+
+                episode_id = record['id']
+                if record['type'] == 'done':
+                    episodes.pop(episode_id, None)
+                    continue
+                if record['type'] == 'snapshot' or episode_id not in episodes:
+                    episodes[episode_id] = {'entries': {key: list(values) for key, values in record['entries'].items()}}
+                else:
+                    entries = episodes[episode_id]['entries']
+                    for key, values in record['entries'].items():
+                        entries[key].extend(values)
+                episodes[episode_id]['cur_iter_num'] = record['cur_iter_num']
+                episodes[episode_id]['retry_cnt'] = record['retry_cnt']
+        return episodes
+
+    def close(self):
+        self.f_out.close()
@@ -0,0 +1,177 @@
+"""
+Shared HTTP transport for the agent, the RAG engine and the data builder.
+
+All remote calls (agent LLM, retriever, answer LLM) go through one pooled client, so TCP
+connections are kept alive and reused across the ~3 calls of every reasoning iteration
+instead of being opened and torn down each time.
+
+Use `get_http_client()` to obtain the process-wide client, or `set_http_client()` to replace
+it, e.g. with one sized for the number of concurrent agents.
+"""
+import json
+import asyncio
+import threading
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Encoder is stateless, build it once instead of on every request
+_json_encoder = json.JSONEncoder(ensure_ascii=True, separators=(',', ':'))
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+def endpoint_key(url):
+    """Concurrency limits are applied per server, i.e. per scheme://host:port."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+class HTTPClient():
+    def __init__(self, pool_maxsize=64, max_concurrency_per_endpoint=None, endpoint_limits=None):
+        """
+        Thread-safe HTTP client with connection pooling and keep-alive.
+        Parameters:
+        - pool_maxsize: Number of keep-alive connections kept per server. Should be >= the number of concurrent callers.
+        - max_concurrency_per_endpoint: Default limit of in-flight requests per server, None means unlimited.
+        - endpoint_limits: Dict of {url or scheme://host:port: limit} overriding the default limit.
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(JSON_HEADERS)
+
+        self.max_concurrency_per_endpoint = max_concurrency_per_endpoint
+        self.endpoint_limits = {endpoint_key(url): limit for url, limit in (endpoint_limits or {}).items()}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, url):
+        key = endpoint_key(url)
+        limit = self.endpoint_limits.get(key, self.max_concurrency_per_endpoint)
+        if limit is None:
+            return nullcontext()
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(limit)
+            return self.semaphores[key]
+
+    def post_json(self, url, payload, timeout=360):
+        """
+        POST `payload` as JSON and return the `requests.Response`; the caller checks the status.
+        """
+        with self.limiter(url):
+            return self.session.post(url, data=_json_encoder.encode(payload), timeout=timeout)
+
+    def stream_json_lines(self, url, payload, timeout=360):
+        """
+        POST `payload` as JSON and yield every line of the streamed response, decoded as JSON.
+        Closing the generator early closes the connection, which cancels the request on the server.
+        """
+        with self.limiter(url):
+            rep = self.session.post(url, data=_json_encoder.encode(payload), timeout=timeout, stream=True)
+            try:
+                rep.raise_for_status()
+                for line in rep.iter_lines():
+                    if line:
+                        yield json.loads(line)
+            finally:
+                rep.close()
+
+    def get(self, url, timeout=10):
+        with self.limiter(url):
+            return self.session.get(url, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+class AsyncHTTPClient():
+    def __init__(self, pool_maxsize=256, max_concurrency_per_endpoint=None, endpoint_limits=None):
+        """
+        asyncio counterpart of HTTPClient, backed by aiohttp (optional dependency).
+        The aiohttp session is created lazily inside the running event loop.
+        """
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency_per_endpoint = max_concurrency_per_endpoint
+        self.endpoint_limits = {endpoint_key(url): limit for url, limit in (endpoint_limits or {}).items()}
+        self.semaphores = {}
+        self.session = None
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            try:
+                import aiohttp
+            except ImportError as e:
+                raise ImportError("AsyncHTTPClient requires aiohttp, please `pip install aiohttp`") from e
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_maxsize, keepalive_timeout=60),
+                headers=JSON_HEADERS,
+                json_serialize=_json_encoder.encode,
+            )
+        return self.session
+
+    def limiter(self, url):
+        key = endpoint_key(url)
+        limit = self.endpoint_limits.get(key, self.max_concurrency_per_endpoint)
+        if limit is None:
+            return nullcontext()
+        if key not in self.semaphores:
+            self.semaphores[key] = asyncio.Semaphore(limit)
+        return self.semaphores[key]
+
+    async def post_json(self, url, payload, timeout=360):
+        """
+        POST `payload` as JSON and return the decoded JSON response.
+        Raises aiohttp.ClientResponseError if the status is not 2xx.
+        """
+        import aiohttp
+        session = self._get_session()
+        async with self.limiter(url):
+            async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as rep:
+                rep.raise_for_status()
+                return await rep.json(content_type=None)
+
+    async def stream_json_lines(self, url, payload, timeout=360):
+        """
+        POST `payload` as JSON and yield every line of the streamed response, decoded as JSON.
+        Closing the generator early closes the connection, which cancels the request on the server.
+        """
+        import aiohttp
+        session = self._get_session()
+        async with self.limiter(url):
+            async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as rep:
+                rep.raise_for_status()
+                async for line in rep.content:
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+_http_client = None
+_async_http_client = None
+_client_lock = threading.Lock()
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        with _client_lock:
+            if _http_client is None:
+                _http_client = HTTPClient()
+    return _http_client
+
+def set_http_client(client):
+    global _http_client
+    _http_client = client
+
+def get_async_http_client():
+    global _async_http_client
+    if _async_http_client is None:
+        _async_http_client = AsyncHTTPClient()
+    return _async_http_client
+
+def set_async_http_client(client):
+    global _async_http_client
+    _async_http_client = client
@@ -1,72 +1,204 @@
 from src.rag_engine import RAGEngine
 from src.agents import ReaRAGAgent
+from src.tokenizer_registry import get_tokenizer
 from src.utils import AgentUtils, print_code
-from transformers import AutoTokenizer
+from src.cache import ObservationCache
+from src.http_client import HTTPClient, set_http_client
+from src.cassette import CassetteClient
+from src.endpoint_pool import configure_endpoint_pools, parse_endpoints
+from src.retriever_transport import LocalRetrieverTransport
 
 QUESTION = "Where was the author of Hannibal and Scipio educated at?"
 ALLOWED_ACTIONS = ["search", "finish"]
 ITER_NUM_MAX = 15 # Number of inference iterations per samples, to avoid infinite loop
 MAX_TRIES = 20 # Number of tries to get a valid generated code 
 
-def main(args):
-    # Load tokenizer
-    rearag_tokenizer = AutoTokenizer.from_pretrained(args.rearag_tokenizer_path, trust_remote_code=True)
-    ans_tokenizer = AutoTokenizer.from_pretrained(args.ans_tokenizer_path, trust_remote_code=True)
+def setup_http_client(args, pool_maxsize=64, max_concurrency_per_endpoint=None):
+    """
+    Install the HTTP client shared by the agent and the rag engine,
+    wrapped in a record/replay cassette if requested.
+    Also sets the options of the endpoint pools used when an API lists several replicas.
+    """
+    configure_endpoint_pools(
+        failure_threshold = args.circuit_failures,
+        cooldown_s = args.circuit_cooldown,
+        hedge_after_ms = args.hedge_after_ms,
+        health_interval_s = args.health_interval,
+        # Agents (one HTTP connection each), their trajectories, plus the observation pool of src.agents
+        max_in_flight = pool_maxsize * max(1, args.n_trajectories) + 64
+    )
+    client = HTTPClient(pool_maxsize=pool_maxsize, max_concurrency_per_endpoint=max_concurrency_per_endpoint)
+    if args.cassette is not None:
+        # Which queries share a /batch_search, and whether a request is hedged, depend on timing
+        assert args.search_batch_size <= 1, "--cassette does not support --search_batch_size > 1, batches are not reproducible"
+        assert args.hedge_after_ms is None, "--cassette does not support --hedge_after_ms, hedged requests are not reproducible"
+        client = CassetteClient(
+            path = args.cassette,
+            mode = args.cassette_mode,
+            client = client if args.cassette_mode == "record" else None,
+            latency = args.replay_latency
+        )
+    set_http_client(client)
+    return client
 
-    # Init RAG engine
-    rag_engine = RAGEngine(
+def build_rag_engine(args, ans_tokenizer, latency_tracker=None):
+    assert args.retriever_api is not None or args.local_retriever_config is not None, \
+        "Either --retriever_api or --local_retriever_config is required"
+    retriever_transport = None
+    if args.local_retriever_config is not None:
+        retriever_transport = LocalRetrieverTransport(args.local_retriever_config)
+
+    observation_cache = None
+    if args.obs_cache_size > 0:
+        observation_cache = ObservationCache(
+            max_size = args.obs_cache_size,
+            disk_path = args.obs_cache_path,
+            deterministic = args.obs_cache_mode == "deterministic",
+            # Entries of the on-disk tier are only reused by runs producing the same observations
+            fingerprint = {
+                'answer_model': args.ans_tokenizer_path,
+                'generation_api': sorted(parse_endpoints(args.gen_api)),
+                'retriever': args.local_retriever_config or sorted(parse_endpoints(args.retriever_api)),
+                'context_token_budget': args.context_token_budget,
+            }
+        )
+
+    return RAGEngine(
         retriever_api = args.retriever_api,
         generation_api = args.gen_api,
         rag_config = {
             'top_k': args.top_k,
+            'search_batch_size': args.search_batch_size,
+            'search_batch_wait_ms': args.search_batch_wait_ms,
+            'context_token_budget': args.context_token_budget,
+            'stream_answer': args.stream_answer,
         },
-        tokenizer = ans_tokenizer      
+        tokenizer = ans_tokenizer,
+        observation_cache = observation_cache,
+        latency_tracker = latency_tracker,
+        retriever_transport = retriever_transport
     )
 
-    # Init agent config
-    agent_config = {
+def build_agent_config(args):
+    return {
         'truncate': True,
         'model_max_length': 8192 - 2 - 1024,
         'max_tokens': 1024,
         'temperature': 1.0,
         'top_p': 0.85,
-        'stop': ["<|user|>", "<|observation|>", "<|assistant|>"]
+        'stop': ["<|user|>", "<|observation|>", "<|assistant|>"],
+        'stream': args.stream_agent, # Stream agent response, dispatch search before generation ends
+        'parallel_search': True, # Run multiple searches of one response concurrently
+        'skip_seen_passages': args.skip_seen_passages, # Do not send passages already shown earlier in the episode
+        'compaction': args.compaction, # Compact old observations once the prompt exceeds compaction_budget
+        'compaction_budget': 8192 - 2 - 1024 - 1024, # Leave room for the observations of the next turns
+        'compact_obs_tokens': 64,
+        'compaction_keep_recent': 1,
+        'fast_finish': args.fast_finish, # Skip the short-answer generation when the answer is short and found in the observations
+        'fast_finish_max_words': 5,
     }
 
-    # Init agent
-    agent_utils = AgentUtils()
-    llm_agent = ReaRAGAgent(
+def build_agent(args, rearag_tokenizer, rag_engine, latency_tracker=None):
+    return ReaRAGAgent(
         agent_api = args.agent_api,
         tokenizer= rearag_tokenizer,
         allowed_actions = ALLOWED_ACTIONS,
         rag_engine = rag_engine, 
         iter_num_max = ITER_NUM_MAX,
         retry_max=MAX_TRIES,
-        agent_config = agent_config,
-        agent_utils = agent_utils
+        agent_config = build_agent_config(args),
+        agent_utils = AgentUtils(),
+        latency_tracker = latency_tracker
     )
-    llm_agent.init_agent(QUESTION)
 
-    # Run the agent, get answer
-    final_answer = llm_agent.run()
-    print_code(llm_agent.reasoning_chain)
-    print(f"Final answer:\n{final_answer.strip()}")
-
-if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser(description='ReaRAG inference')
+def add_common_args(parser):
     parser.add_argument('--agent_api', type=str, 
-                        required=True, help="API to ReaRAG model")
-    parser.add_argument('--retriever_api', type=str, 
-                        required=True, help="search API")
+                        required=True, help="API to ReaRAG model, or comma-separated replicas")
+    parser.add_argument('--retriever_api', type=str, default=None,
+                        help="search API, or comma-separated replicas. Required unless --local_retriever_config is given")
+    parser.add_argument('--local_retriever_config', type=str, default=None,
+                        help="flashrag retriever config (e.g. deploy/retriever_config.yaml) to run the retriever in-process instead of over HTTP")
     parser.add_argument('--gen_api', type=str, 
-                        required=True, help="generation API for RAG engine")
+                        required=True, help="generation API for RAG engine, or comma-separated replicas")
+    parser.add_argument('--circuit_failures', type=int, default=3,
+                        help="consecutive failures after which a replica is taken out of rotation")
+    parser.add_argument('--circuit_cooldown', type=float, default=30,
+                        help="seconds a failing replica stays out of rotation")
+    parser.add_argument('--hedge_after_ms', type=float, default=None,
+                        help="send a copy of a request still running after that long to another replica, default disabled")
+    parser.add_argument('--health_interval', type=float, default=None,
+                        help="poll /health of every replica at this interval (seconds), default disabled")
     parser.add_argument('--rearag_tokenizer_path', type=str, 
                         required=True, help="Tokenizer path for ReaRAG")
     parser.add_argument('--ans_tokenizer_path', type=str, 
                         required=True, help="Tokenizer path for answer generation LLM in rag engine")
     parser.add_argument('--top_k', type=int, default=3,
                         help="number of retrieved documents")
+    parser.add_argument('--search_batch_size', type=int, default=1,
+                        help="gather up to this many concurrent searches into one /batch_search request, 1 disables batching")
+    parser.add_argument('--search_batch_wait_ms', type=float, default=5,
+                        help="how long a search waits for others to join its batch")
+    parser.add_argument('--context_token_budget', type=int, default=None,
+                        help="max tokens of passages / search results packed into the answer prompts, default unlimited")
+    parser.add_argument('--obs_cache_size', type=int, default=0,
+                        help="number of observations (search + answer) cached in memory, 0 disables the cache")
+    parser.add_argument('--obs_cache_path', type=str, default=None,
+                        help="optional sqlite file used as on-disk tier of the observation cache")
+    parser.add_argument('--obs_cache_mode', type=str, default="deterministic", choices=["deterministic", "sampled"],
+                        help="deterministic: cached answers are generated greedily. sampled: keep sampling, reuse the first sample")
+    parser.add_argument('--skip_seen_passages', action='store_true',
+                        help="drop retrieved passages that were already shown to the answer model earlier in the episode")
+    parser.add_argument('--compaction', action='store_true',
+                        help="replace old observations by compact summaries when the prompt grows too long, instead of truncating")
+    parser.add_argument('--cassette', type=str, default=None,
+                        help="JSONL file to record the remote calls to, or to replay them from")
+    parser.add_argument('--cassette_mode', type=str, default="replay", choices=["record", "replay"],
+                        help="record: call the servers and save the responses. replay: serve responses from the cassette")
+    parser.add_argument('--replay_latency', type=str, default="recorded",
+                        help="replay only. 'recorded', 'none', or a number of seconds per request")
+    parser.add_argument('--fast_finish', action='store_true',
+                        help="return the agent's answer as is when it is short and appears in the observations, instead of asking the answer LLM to shorten it")
+    parser.add_argument('--n_trajectories', type=int, default=1,
+                        help="self-consistency: run this many trajectories per question and return the majority answer. Above 1, requires vllm_async_serving.py")
+    parser.add_argument('--quorum', type=int, default=None,
+                        help="self-consistency: stop once this many trajectories agree, default a majority")
+    parser.add_argument('--stream_answer', action='store_true',
+                        help="stream the answers of the RAG engine and record their time to first token / per output token")
+    parser.add_argument('--stream_agent', action='store_true',
+                        help="stream agent responses and start the search as soon as the action is complete. Requires vllm_async_serving.py")
+    return parser
+
+def main(args):
+    setup_http_client(args)
+
+    # Load tokenizer
+    # Loaded in the background while the rest is set up, shared if both paths are the same
+    rearag_tokenizer = get_tokenizer(args.rearag_tokenizer_path).prefetch()
+    ans_tokenizer = get_tokenizer(args.ans_tokenizer_path).prefetch()
+
+    # Init RAG engine
+    rag_engine = build_rag_engine(args, ans_tokenizer)
+
+    # Init agent
+    llm_agent = build_agent(args, rearag_tokenizer, rag_engine)
+    llm_agent.init_agent(QUESTION)
+
+    # Run the agent, get answer
+    if args.n_trajectories > 1:
+        final_answer = llm_agent.run_self_consistency(args.n_trajectories, args.quorum)
+        print(f"Votes: {llm_agent.votes}")
+    else:
+        final_answer = llm_agent.run()
+    print_code(llm_agent.reasoning_chain)
+    if final_answer is None:
+        print("Final answer:\nno answer, no trajectory finished") # Self-consistency without any answer, see the votes
+    else:
+        print(f"Final answer:\n{final_answer.strip()}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='ReaRAG inference')
+    add_common_args(parser)
     args = parser.parse_args()
 
     main(args)
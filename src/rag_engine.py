@@ -1,6 +1,26 @@
 
-import requests
+import json
+import hashlib
+from contextlib import nullcontext
 from termcolor import colored
+from src.http_client import get_http_client, get_async_http_client
+from src.batching import MicroBatcher
+from src.cache import SingleFlight
+from src.endpoint_pool import get_endpoint_pool
+from src.retriever_transport import HTTPRetrieverTransport
+from src.utils import StreamStats, trim_to_sentences
+
+def passage_key(passage):
+    """Identity of a passage: its document id if it has one, otherwise a hash of its content."""
+    if isinstance(passage, dict):
+        if passage.get('id') is not None:
+            return f"id:{passage['id']}"
+        passage = passage['contents']
+    return hashlib.blake2b(passage.encode('utf-8'), digest_size=16).hexdigest()
+
+def passage_text(passage):
+    """Passages are documents returned by Search, or plain strings."""
+    return passage['contents'] if isinstance(passage, dict) else passage
 
 class RAGEngineBase:
     def __init__(self, retriever_api, generation_api, rag_config, tokenizer):
@@ -16,6 +36,8 @@ class RAGEngineBase:
         self.generation_api = generation_api
         self.rag_config = rag_config
         self.tokenizer = tokenizer
+        # Concurrent identical searches and deterministic generations share one upstream call
+        self.single_flight = SingleFlight() if rag_config.get('single_flight', True) else None
 
     def Search(self):
         """
@@ -31,7 +53,7 @@ class RAGEngineBase:
         """
         raise NotImplementedError("The 'Answer' method must be implemented in a subclass.")
 
-    def get_response(self, prompt, base_url, parameters=None):
+    def build_generation_request(self, prompt, parameters=None, stream=False):
         if parameters is None:
             parameters = {
                     "max_tokens": 1024,
@@ -40,25 +62,36 @@ class RAGEngineBase:
                     "stop": None,
                     "skip_special_tokens": False
                 }
-        try:
-            rep = requests.post(
-                base_url,
-                json={
-                    'inputs': prompt,
-                    'stream': False,
-                    "parameters": parameters
-                },
-                headers={
-                    'Content-Type': 'application/json'
-                },
-                timeout=360
-            )
+        return {
+            'inputs': prompt,
+            'stream': stream,
+            "parameters": parameters
+        }
+
+    def get_response(self, prompt, base_url, parameters=None):
+        """
+        `base_url` is a URL, or several replicas (see src.endpoint_pool).
+        """
+        payload = self.build_generation_request(prompt, parameters)
+        if self.single_flight is not None and payload['parameters'].get('temperature') == 0:
+            key = ('generate', str(base_url), json.dumps(payload, sort_keys=True))
+            return self.single_flight.do(key, lambda: self._get_response(payload, base_url))
+        return self._get_response(payload, base_url)
+
+    def _get_response(self, payload, base_url):
+        def post(url):
+            rep = get_http_client().post_json(url, payload, timeout=360)
             rep.raise_for_status()  # <-- raises an HTTPError if status != 200
-            
+            return rep
+
+        try:
+            rep = get_endpoint_pool(base_url).call(post)
         except Exception as e:
-            print(colored(f"In get_response, Error parsing JSON: {e}", 'red'))
-            print(colored(f"In get_response, HTTP status code: {rep.status_code}", 'red'))
-            print(colored(f"In get_response, Raw response text: {rep.text}", 'red'))
+            print(colored(f"In get_response, Error in HTTP request: {e}", 'red'))
+            failed_rep = getattr(e, 'response', None)
+            if failed_rep is not None:
+                print(colored(f"In get_response, HTTP status code: {failed_rep.status_code}", 'red'))
+                print(colored(f"In get_response, Raw response text: {failed_rep.text}", 'red'))
             raise
 
         # If everything is OK:
@@ -67,39 +100,175 @@ class RAGEngineBase:
         generation = response['outputs'][0]['generated_text']
         return generation
 
+    def get_response_stream(self, prompt, base_url, parameters=None, stats=None):
+        """
+        Synchronous streaming generation, yield the text as it is generated.
+        `stats` is an optional src.utils.StreamStats, which records TTFT and TPOT.
+        """
+        stats = stats or StreamStats(self.tokenizer)
+        try:
+            payload = self.build_generation_request(prompt, parameters, stream=True)
+            for chunk in get_endpoint_pool(base_url).stream(lambda url: get_http_client().stream_json_lines(url, payload, timeout=360)):
+                delta = stats.update(chunk['text'])
+                if delta:
+                    yield delta
+        except Exception as e:
+            print(colored(f"In get_response_stream, Error in HTTP request: {e}", 'red'))
+            raise
+        stats.finish()
+
+    async def aget_response_stream(self, prompt, base_url, parameters=None, stats=None):
+        """
+        asyncio counterpart of get_response_stream, backed by src.http_client.AsyncHTTPClient.
+        """
+        stats = stats or StreamStats(self.tokenizer)
+        try:
+            payload = self.build_generation_request(prompt, parameters, stream=True)
+            async for chunk in get_endpoint_pool(base_url).astream(lambda url: get_async_http_client().stream_json_lines(url, payload, timeout=360)):
+                delta = stats.update(chunk['text'])
+                if delta:
+                    yield delta
+        except Exception as e:
+            print(colored(f"In aget_response_stream, Error in HTTP request: {e}", 'red'))
+            raise
+        stats.finish()
+
 class RAGEngine(RAGEngineBase):
-    def __init__(self, retriever_api, generation_api, rag_config, tokenizer):
+    def __init__(self, retriever_api, generation_api, rag_config, tokenizer, observation_cache=None, latency_tracker=None,
+                 retriever_transport=None):
+        """
+        - observation_cache: Optional src.cache.ObservationCache placed in front of SearchAndAnswer.
+        - latency_tracker: Optional src.utils.LatencyTracker, records TTFT/TPOT of streamed answers.
+        - retriever_transport: How Search reaches the retriever, see src.retriever_transport.
+          Defaults to HTTP calls to `retriever_api`.
+        """
         super().__init__(retriever_api, generation_api, rag_config, tokenizer)
+        self.observation_cache = observation_cache
+        self.latency_tracker = latency_tracker
+
+        if retriever_transport is None:
+            retriever_transport = HTTPRetrieverTransport(retriever_api, rag_config.get('batch_retriever_api'))
+        self.retriever_transport = retriever_transport
+
+        # Gather concurrent Search calls of many agents into /batch_search requests
+        self.search_batcher = None
+        if rag_config.get('search_batch_size', 1) > 1:
+            self.search_batcher = MicroBatcher(
+                self.BatchSearch,
+                max_batch_size=rag_config['search_batch_size'],
+                max_wait_ms=rag_config.get('search_batch_wait_ms', 5)
+            )
 
     def Search(self, query):
+        """
+        Return the top_k documents of the query. The returned list may be shared with concurrent
+        callers of the same query, do not modify it.
+        """
+        if self.single_flight is not None:
+            return self.single_flight.do(('search', query, self.rag_config['top_k']), lambda: self._search(query))
+        return self._search(query)
+
+    def _search(self, query):
+        if self.search_batcher is not None:
+            return self.search_batcher.submit(query).result()
+
         try:
-            rep = requests.post(
-                url=self.retriever_api,
-                json={
-                    'query': query,
-                    'top_n': self.rag_config['top_k'],
-                    "return_score": False
-                },
-                headers={
-                    'Content-Type': 'application/json'
-                },
-                timeout=300
-            )
-            rep.raise_for_status()  # <-- raises an HTTPError if status != 200
+            docs, scores = self.retriever_transport.search(query, self.rag_config['top_k'])
 
         except Exception as e:
-            print(colored(f"In Search, Error in HTTP request: {e}", 'red'))
+            print(colored(f"In Search, Error in retrieval: {e}", 'red'))
             raise
         
-        # If everything is OK:
-        search_result = rep.json()
-        return search_result 
+        # If everything is OK: attach the retrieval score to each document
+        for doc, score in zip(docs, scores):
+            doc['score'] = score
+        return docs
     
-    def Answer(self, question, prompt_template, generation_config, memory=None, system_msg=None):
+    def BatchSearch(self, queries):
+        """
+        Search for several queries with one request, return one list of documents per query.
+        """
+        try:
+            batch_docs, batch_scores = self.retriever_transport.batch_search(queries, self.rag_config['top_k'])
+
+        except Exception as e:
+            print(colored(f"In BatchSearch, Error in retrieval: {e}", 'red'))
+            raise
+
+        # If everything is OK: attach the retrieval score to each document
+        for docs, scores in zip(batch_docs, batch_scores):
+            for doc, score in zip(docs, scores):
+                doc['score'] = score
+        return batch_docs
+
+    def select_passages(self, memory, seen=None):
+        """
+        De-duplicate passages by document id or content hash.
+        If `seen` (a set-like of passage keys, e.g. src.conversation.PassageJournal) is given, passages already
+        shown earlier in the episode are dropped too. `seen` is only read, recording the kept passages
+        is up to the owner of the episode state (see passage_key).
+        If every passage was already shown, they are all kept rather than answering from an empty context.
+
+        Return the kept passages and the number of passages dropped because of `seen`.
+        """
+        unique = {}
+        for passage in memory:
+            unique.setdefault(passage_key(passage), passage)
+
+        if seen is None:
+            return list(unique.values()), 0
+
+        fresh = [passage for key, passage in unique.items() if key not in seen]
+        if not fresh:
+            return list(unique.values()), 0
+        return fresh, len(unique) - len(fresh)
+
+    def pack_passages(self, passages, token_budget, min_tokens=32):
+        """
+        Fit passages into `token_budget` tokens of the answer tokenizer.
+        Passages are taken by decreasing retrieval score (plain strings keep their order), and the
+        first one that does not fit is trimmed at a sentence boundary if at least `min_tokens` are left.
+        Return the texts of the packed passages, and the passages packed in full (not the trimmed one).
+        """
+        if any(isinstance(passage, dict) and 'score' in passage for passage in passages):
+            passages = sorted(passages, key=lambda p: p.get('score', float('-inf')) if isinstance(p, dict) else float('-inf'), reverse=True)
+
+        separator_tokens = len(self.tokenizer.encode('\n\n', add_special_tokens=False))
         chunks = []
-        for _ in memory:
-            if _ not in chunks:
-                chunks.append(_['contents'])
+        packed = []
+        remaining = token_budget
+        for passage in passages:
+            text = passage_text(passage)
+            n_tokens = len(self.tokenizer.encode(text, add_special_tokens=False)) + separator_tokens
+            if n_tokens <= remaining:
+                chunks.append(text)
+                packed.append(passage)
+                remaining -= n_tokens
+                continue
+
+            if remaining - separator_tokens >= min_tokens:
+                trimmed, _ = trim_to_sentences(self.tokenizer, text, remaining - separator_tokens)
+                if trimmed:
+                    chunks.append(trimmed)
+            break
+        return chunks, packed
+
+    def build_answer_prompt(self, question, prompt_template, memory=None, system_msg=None, shown=None):
+        """
+        Chat prompt of the answer LLM. If `shown` (a list) is given, the keys of the passages that
+        made it into the prompt in full are appended to it; passages dropped or trimmed by the
+        token budget are not.
+        """
+        passages, _ = self.select_passages(memory or [])
+        token_budget = self.rag_config.get('context_token_budget')
+        if token_budget:
+            # Bound the prefill cost of the answer LLM
+            chunks, packed = self.pack_passages(passages, token_budget)
+        else:
+            chunks = [passage_text(passage) for passage in passages]
+            packed = passages
+        if shown is not None:
+            shown.extend(passage_key(passage) for passage in packed)
         
         prompt = prompt_template.format('\n\n'.join(chunks), question)
 
@@ -110,15 +279,72 @@ class RAGEngine(RAGEngineBase):
             {"role": "user", "content": prompt},
         ]
 
-        prompt = self.tokenizer.apply_chat_template(
+        return self.tokenizer.apply_chat_template(
                     conversation_chain,
                     add_special_tokens=False,  # Set True if you want special tokens
                     tokenize=False,  # Set True if you want tokenized result
                     add_generation_prompt=True  # Ensures correct format for model to continue generating
                 )
+
+    def Answer(self, question, prompt_template, generation_config, memory=None, system_msg=None, shown=None):
+        """
+        Return the generated answer. If rag_config['stream_answer'] is set, the answer is streamed
+        and assembled here, which records its TTFT/TPOT.
+        `shown` optionally collects the keys of the passages in the prompt, see build_answer_prompt.
+        """
+        prompt = self.build_answer_prompt(question, prompt_template, memory, system_msg, shown)
         try:
-            response = self.get_response(prompt, self.generation_api, generation_config)
+            if self.rag_config.get('stream_answer', False):
+                stats = StreamStats(self.tokenizer)
+                response = ''.join(self.get_response_stream(prompt, self.generation_api, generation_config, stats)).strip()
+                stats.record(self.latency_tracker, "answer")
+            else:
+                response = self.get_response(prompt, self.generation_api, generation_config)
         except Exception as e:
             print(colored(f"In Answer, Error in get_response: {e}", 'red'))
             raise
-        return response
\ No newline at end of file
+        return response
+
+    async def AnswerStream(self, question, prompt_template, generation_config, memory=None, system_msg=None, stats=None):
+        """
+        Async iterator over the text of the answer as it is generated, e.g.
+            async for delta in rag_engine.AnswerStream(question, long_ans_prompt, generation_config, memory): ...
+        TTFT/TPOT are recorded in `stats` (src.utils.StreamStats) if given, and in the latency tracker.
+        """
+        prompt = self.build_answer_prompt(question, prompt_template, memory, system_msg)
+        stats = stats or StreamStats(self.tokenizer)
+        async for delta in self.aget_response_stream(prompt, self.generation_api, generation_config, stats):
+            yield delta
+        stats.record(self.latency_tracker, "answer")
+
+    def SearchAndAnswer(self, query, prompt_template, generation_config, track=None, seen=None, shown=None):
+        """
+        Search for the query, then Answer it from the retrieved documents.
+        If an observation cache is attached, repeated queries are served from it.
+        `track` is an optional callable returning a context manager that times a stage, e.g. ReaRAGAgent.track.
+        `seen` optionally holds the keys of passages already shown in the episode, see select_passages.
+        If `shown` (a list) is given, the keys of the passages the answer was generated from are appended to it.
+        """
+        if track is None:
+            track = lambda stage: nullcontext()
+
+        cache = self.observation_cache
+        if cache is not None:
+            key = cache.make_key(query, self.rag_config['top_k'], prompt_template)
+            observation = cache.get(key)
+            if observation is not None:
+                return observation
+            generation_config = cache.generation_config(generation_config)
+
+        with track("search"):
+            mem = self.Search(query)
+        n_dropped = 0
+        if seen is not None:
+            mem, n_dropped = self.select_passages(mem, seen)
+        with track("answer"):
+            observation = self.Answer(query, prompt_template, generation_config, mem, shown=shown)
+
+        # An answer from a reduced context depends on the episode, do not share it
+        if cache is not None and n_dropped == 0:
+            cache.put(key, observation)
+        return observation
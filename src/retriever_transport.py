@@ -0,0 +1,77 @@
+"""
+Transports used by RAGEngine to reach the retriever.
+
+- HTTPRetrieverTransport calls `/search` and `/batch_search` of deploy/retriever_serving.py (default).
+- LocalRetrieverTransport runs a flashrag retriever built with `flashrag.utils.get_retriever` in the
+  current process, which saves the JSON round trip of full passages and the pydantic validation on
+  both sides, e.g. for batch evaluation on a single machine.
+
+Both return `(docs, scores)` for one query and `(batch_docs, batch_scores)` for several queries,
+where every document is `{'id': str, 'contents': str}`, exactly as served by retriever_serving.py.
+"""
+import threading
+
+from src.http_client import get_http_client
+from src.endpoint_pool import get_endpoint_pool, parse_endpoints
+
+class HTTPRetrieverTransport():
+    def __init__(self, retriever_api, batch_retriever_api=None):
+        """
+        Parameters:
+        - retriever_api: URL of `/search`, or several replicas (see src.endpoint_pool).
+        - batch_retriever_api: URL of `/batch_search`, next to `/search` unless given.
+        """
+        self.retriever_api = retriever_api
+        self.batch_retriever_api = batch_retriever_api
+        retriever_urls = parse_endpoints(retriever_api)
+        if self.batch_retriever_api is None and all(url.endswith('/search') for url in retriever_urls):
+            self.batch_retriever_api = ','.join(url[:-len('/search')] + '/batch_search' for url in retriever_urls)
+
+    def _post(self, spec, payload):
+        def post(url):
+            rep = get_http_client().post_json(url, payload, timeout=300)
+            rep.raise_for_status()  # <-- raises an HTTPError if status != 200
+            return rep
+
+        docs, scores = get_endpoint_pool(spec).call(post).json()
+        return docs, scores
+
+    def search(self, query, top_n):
+        return self._post(self.retriever_api, {'query': query, 'top_n': top_n, "return_score": True})
+
+    def batch_search(self, queries, top_n):
+        return self._post(self.batch_retriever_api, {'query': queries, 'top_n': top_n, "return_score": True})
+
+class LocalRetrieverTransport():
+    def __init__(self, config_path=None, retriever=None):
+        """
+        Parameters:
+        - config_path: flashrag retriever config, e.g. deploy/retriever_config.yaml.
+        - retriever: An already built flashrag retriever, used instead of `config_path`.
+        flashrag is vendored in deploy/, which must be on PYTHONPATH.
+        """
+        if retriever is None:
+            try:
+                from flashrag.config import Config
+                from flashrag.utils import get_retriever
+            except ImportError as e:
+                raise ImportError("LocalRetrieverTransport requires flashrag, add deploy/ to PYTHONPATH") from e
+            retriever = get_retriever(Config(config_path))
+        self.retriever = retriever
+        # The retriever holds one encoder and one index, one search at a time as in retriever_serving.py
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def to_documents(results):
+        return [{'id': str(result['id']), 'contents': result['contents']} for result in results]
+
+    def search(self, query, top_n):
+        with self.lock:
+            results, scores = self.retriever.search(query, top_n, True)
+        return self.to_documents(results), [float(score) for score in scores]
+
+    def batch_search(self, queries, top_n):
+        with self.lock:
+            batch_results, batch_scores = self.retriever.batch_search(queries, top_n, True)
+        return ([self.to_documents(results) for results in batch_results],
+                [[float(score) for score in scores] for scores in batch_scores])
@@ -0,0 +1,147 @@
+"""
+Process-wide registry of HF tokenizers.
+
+- Lazy: `get_tokenizer(path)` returns at once, the tokenizer is loaded on first use
+  (or in the background after `prefetch()`).
+- Shared: paths resolving to the same directory share one instance, e.g. the ReaRAG
+  tokenizer of the agent and the answer tokenizer of RAGEngine when both point to the same model.
+- Cached: fast tokenizers implemented in transformers are saved once with `save_pretrained`
+  to a local cache directory, and loaded from their serialized `tokenizer.json` afterwards,
+  without executing remote code. A cache entry is keyed on the size and mtime of every tokenizer
+  file of a local directory, or on the resolved commit of a hub name, so edited files or a new
+  revision are loaded again. Tokenizers using remote code or without a fast implementation
+  (e.g. the GLM-4 tokenizers of ReaRAG-9B and glm-4-9b-chat) are never cached, they are only lazy and shared.
+  The cache directory is `$REARAG_TOKENIZER_CACHE`, by default ~/.cache/rearag/tokenizers.
+"""
+import os
+import shutil
+import hashlib
+import threading
+
+import transformers
+from transformers import AutoTokenizer
+from transformers.utils import cached_file, extract_commit_hash
+
+def tokenizer_cache_dir():
+    return os.environ.get("REARAG_TOKENIZER_CACHE", os.path.expanduser("~/.cache/rearag/tokenizers"))
+
+def resolve_path(path):
+    """Local directories are identified by their real path, hub names are kept as is."""
+    return os.path.realpath(path) if os.path.exists(path) else path
+
+TOKENIZER_FILES = {
+    "tokenizer.json", "tokenizer_config.json", "special_tokens_map.json", "added_tokens.json",
+    "chat_template.jinja", "chat_template.json", "config.json", "vocab.json", "vocab.txt", "merges.txt",
+}
+
+def is_tokenizer_file(name):
+    return (name in TOKENIZER_FILES or name.endswith((".model", ".tiktoken"))
+            or (name.startswith("tokenization_") and name.endswith(".py")))
+
+def hub_commit_hash(path):
+    """Commit of the revision a hub name resolves to (from the local HF cache when offline), None if unknown."""
+    try:
+        resolved = cached_file(path, "tokenizer_config.json", _raise_exceptions_for_missing_entries=False)
+    except Exception:
+        return None
+    return extract_commit_hash(resolved, None) if resolved else None
+
+def cache_path(path):
+    """
+    Cache entry of a tokenizer, invalidated when one of its files, its hub revision or the transformers version changes.
+    Return None if the version of the tokenizer cannot be identified, it is then not cached.
+    """
+    stamp = f"{path}\n{transformers.__version__}"
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if is_tokenizer_file(name):
+                stat = os.stat(os.path.join(path, name))
+                stamp += f"\n{name}:{stat.st_size}:{stat.st_mtime_ns}"
+    else:
+        commit_hash = hub_commit_hash(path)
+        if commit_hash is None:
+            return None
+        stamp += f"\n{commit_hash}"
+    return os.path.join(tokenizer_cache_dir(), hashlib.sha1(stamp.encode('utf-8')).hexdigest()[:16])
+
+def is_cacheable(tokenizer):
+    """Only tokenizers that load back from tokenizer.json without remote code are cached."""
+    return tokenizer.is_fast and type(tokenizer).__module__.startswith("transformers.")
+
+def load_tokenizer(path, trust_remote_code=True):
+    cached = cache_path(path)
+    if cached is not None and os.path.exists(os.path.join(cached, "tokenizer.json")):
+        return AutoTokenizer.from_pretrained(cached)
+
+    tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=trust_remote_code)
+    if cached is not None and is_cacheable(tokenizer):
+        tmp = f"{cached}.tmp{os.getpid()}"
+        try:
+            tokenizer.save_pretrained(tmp)
+            os.replace(tmp, cached)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True) # Cache is best effort, e.g. read-only home or a concurrent writer
+    return tokenizer
+
+class LazyTokenizer():
+    def __init__(self, path, trust_remote_code=True):
+        """
+        Proxy of a HF tokenizer, loaded on first attribute access.
+        Parameters:
+        - path: Local directory or hub name of the tokenizer.
+        - trust_remote_code: Passed to AutoTokenizer.from_pretrained when the tokenizer is not cached.
+        """
+        self.path = path
+        self.trust_remote_code = trust_remote_code
+        self._tokenizer = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def prefetch(self):
+        """Start loading in a background thread, so that it overlaps with other startup work."""
+        with self._lock:
+            if self._tokenizer is None and self._thread is None:
+                self._thread = threading.Thread(target=self.load, daemon=True)
+                self._thread.start()
+        return self
+
+    def load(self):
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    self._tokenizer = load_tokenizer(self.path, self.trust_remote_code)
+        return self._tokenizer
+
+    def __getstate__(self):
+        # The lock and loading thread are not copied, a copy loads on its own if not loaded yet
+        return {'path': self.path, 'trust_remote_code': self.trust_remote_code, '_tokenizer': self._tokenizer}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the proxy itself. Private and dunder names are not
+        # delegated: copy and pickle look them up on instances without __init__ state, where
+        # self.load() would recurse through this method
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __len__(self):
+        return len(self.load())
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
+def get_tokenizer(path, trust_remote_code=True):
+    """Return the shared LazyTokenizer of `path`."""
+    key = resolve_path(path)
+    with _tokenizers_lock:
+        if key not in _tokenizers:
+            _tokenizers[key] = LazyTokenizer(key, trust_remote_code)
+        return _tokenizers[key]
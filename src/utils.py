@@ -1,5 +1,60 @@
 import re
+import math
+import string
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from termcolor import colored
+from src.action_parser import STEP_PATTERN, FENCED_CODE_PATTERN, extract_code, parse_action, parse_reasoning_steps
+
+SENTENCE_END_PATTERN = re.compile(r'(?<=[.!?])\s+|(?<=[。！？])')
+
+def trim_to_sentences(tokenizer, text, max_tokens):
+    """
+    Longest prefix of whole sentences of `text` that fits in `max_tokens` tokens.
+    Return the trimmed text ('' if even the first sentence does not fit) and whether the whole text was kept.
+    """
+    sentences = SENTENCE_END_PATTERN.split(text.strip())
+    kept = []
+    n_tokens = 0
+    for sentence in sentences:
+        n_tokens += len(tokenizer.encode(sentence, add_special_tokens=False))
+        if n_tokens > max_tokens:
+            break
+        kept.append(sentence)
+    return ' '.join(kept), len(kept) == len(sentences)
+
+class StreamingStepParser():
+    """
+    Incrementally parse a streamed agent response, fed with the cumulative generated text.
+    - action_end: index right after the closing fence of the first action, None while it is still open.
+    - extra_start: index where a step after the first action begins, None if there is none yet.
+    """
+    def __init__(self):
+        self.text = ""
+        self.action_end = None
+        self.extra_start = None
+
+    def feed(self, text):
+        self.text = text
+        if self.action_end is None:
+            for match in STEP_PATTERN.finditer(text):
+                if match.group(1) == "Action":
+                    fence = FENCED_CODE_PATTERN.search(text, match.end())
+                    if fence:
+                        self.action_end = fence.end()
+                    break
+
+        if self.action_end is not None and self.extra_start is None:
+            match = STEP_PATTERN.search(text, self.action_end)
+            if match:
+                self.extra_start = match.start()
+
+    def first_step(self):
+        """Text of the first Thought/Action, once its action is complete."""
+        return None if self.action_end is None else self.text[:self.action_end]
 
 class AgentUtilsBase():
     def __init__(self):
@@ -12,19 +67,27 @@ class AgentUtilsBase():
         
         return prompt
 
+    def compact_observation(self, tokenizer, text, max_tokens):
+        """
+        Shorten an observation to at most `max_tokens` tokens, cutting at a sentence boundary.
+        Keeps at least the first sentence, trimmed by tokens if that sentence alone is too long.
+        """
+        compact, complete = trim_to_sentences(tokenizer, text, max_tokens)
+        if complete:
+            return compact
+        if compact:
+            return compact + " ..."
+        first_sentence = SENTENCE_END_PATTERN.split(text.strip(), maxsplit=1)[0]
+        tokens = tokenizer.encode(first_sentence, add_special_tokens=False)[:max_tokens]
+        return tokenizer.decode(tokens, skip_special_tokens=False) + " ..."
+
     def preprocess_query(self, query):
         if "'" in query and '"' in query:
             query = query.replace("'", "\\'").replace('"', '\\"')
         return query
 
     def extract_code(self, text: str) -> str:
-        triple_match = re.search(r'```[^\n]*\n(.+?)```', text, re.DOTALL)
-        single_match = re.search(r'`([^`]*)`', text, re.DOTALL)
-        if triple_match:
-            return triple_match.group(1)
-        elif single_match:
-            return single_match.group(1)
-        return text
+        return extract_code(text)
     
     def postprocess_agent_response(self, response):
         """
@@ -38,83 +101,10 @@ class AgentUtils(AgentUtilsBase):
 
     def parse_reasoning_steps(self, text: str):
         """
-        Parse a string containing Thought/Action/Observation steps (including multi-line)
-        and return a list of dictionaries of the form:
-        
-        [
-            {
-                "1": {
-                    "Thought": "...",
-                    "Action": "...",  # Only content inside backticks (if present)
-                    "Observation": "..."
-                }
-            },
-            {
-                "2": {
-                    "Thought": "...",
-                    "Action": "...",
-                    "Observation": "..."
-                }
-            },
-            ...
-        ]
+        Parse a string containing Thought/Action/Observation steps (including multi-line),
+        see src.action_parser.parse_reasoning_steps for the returned structure.
         """
-        # Regex pattern to match lines that start with "Thought X:", "Action X:", or "Observation X:".
-        pattern = re.compile(r'^(Thought|Action|Observation)\s+(\d+):', re.MULTILINE)
-
-        # This dictionary will accumulate:
-        # data_dict[step_number] = {"Thought": ..., "Action": ..., "Observation": ...}
-        data_dict = {}
-
-        # We'll track the current label (Thought/Action/Observation) and step number
-        current_label = None
-        current_step = None
-        last_pos = 0
-
-        # Find all pattern occurrences in the text
-        matches = list(pattern.finditer(text))
-
-        for match in matches:
-            # If we already have a label in progress, we can record its content
-            if current_label is not None:
-                # Slice the text from the last match's end to the start of this new match
-                content = text[last_pos:match.start()].strip()
-                # Store that content in data_dict
-                data_dict[current_step][current_label] = content
-
-            # Extract the new label and step
-            label = match.group(1)       # "Thought", "Action", or "Observation"
-            step = match.group(2)        # e.g. "1", "2", "3"
-
-            # Ensure a dict for this step
-            if step not in data_dict:
-                data_dict[step] = {"Thought": None, "Action": None, "Observation": None}
-
-            # Update current label/step
-            current_label = label
-            current_step = step
-            # We'll slice from here next time
-            last_pos = match.end()
-
-        # Handle the final block after the last match
-        if current_label is not None:
-            content = text[last_pos:].strip()
-            data_dict[current_step][current_label] = content
-
-        # Post-process:
-        #  - For each step, extract only the text inside triple backticks for "Action".
-        for step_number in data_dict:
-            action_text = data_dict[step_number]["Action"]
-            if action_text:
-                # Extract content inside triple backticks
-                data_dict[step_number]["Action"] = self.extract_code(action_text)
-
-        # Convert our dictionary to the desired list-of-dicts structure
-        structured_data = []
-        for step_number in sorted(data_dict.keys(), key=lambda x: int(x)):
-            structured_data.append({step_number: data_dict[step_number]})
-
-        return structured_data
+        return parse_reasoning_steps(text)
     
     def postprocess_agent_response(self, response):
         """
@@ -132,19 +122,124 @@ class AgentUtils(AgentUtilsBase):
         for steps in parsed_codes:
             for step_idx, step in steps.items():
                 thought = f"Thought {step_idx}: {step['Thought']}"
-                action = eval(self.extract_code(step['Action']))
-
-                assert "function" in action, f"Action does not contain 'function' key: {action}"
-                assert "parameters" in action, f"Action does not contain 'parameters' key: {action}"
+                action = parse_action(self.extract_code(step['Action'])) # Raises ValueError if not a valid action
 
                 thoughts.append(thought)
                 actions.append(action)
 
         return thoughts, actions
     
+def normalize_answer(s):
+    """Lower text and remove punctuation, articles and extra whitespace, as in src_data/metrics.py."""
+    s = ''.join(ch for ch in s.lower() if ch not in string.punctuation)
+    s = re.sub(r"\b(a|an|the)\b", " ", s)
+    return ' '.join(s.split())
+
 def print_code(codes):
     for idx, step in enumerate(codes):
         print(f"{colored(step['thought'], 'blue')}")
         print(colored(f"Action {idx+1}:\n```\n{step['action']}\n```", 'red'))
         print(colored(f"Observation {idx+1}: {step['observation']}", 'yellow'))
         # print(f"{'-'*60}")
+
+
+def read_jsonl(filepath):
+    with open(filepath, 'r') as f:
+        data = [json.loads(line) for line in f if line.strip()]
+    return data
+
+def append_jsonl(f_out, item):
+    """Write one item to an opened JSONL file and flush it, so results survive a crash."""
+    f_out.write(json.dumps(item, ensure_ascii=False) + '\n')
+    f_out.flush()
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers, q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+class StreamStats():
+    """
+    Timing of one streamed generation: time to first token (TTFT) and time per output token (TPOT).
+    Fed with the cumulative text of every chunk, as sent by vllm_async_serving.py.
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.start = time.perf_counter()
+        self.text = ''
+        self.ttft = None
+        self.tpot = None
+        self.total = None
+        self.n_tokens = 0
+
+    def update(self, text):
+        """Record a chunk and return the newly generated text."""
+        if self.ttft is None and text:
+            self.ttft = time.perf_counter() - self.start
+        delta = text[len(self.text):]
+        self.text = text
+        return delta
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        self.n_tokens = len(self.tokenizer.encode(self.text, add_special_tokens=False))
+        if self.ttft is not None and self.n_tokens > 1:
+            self.tpot = (self.total - self.ttft) / (self.n_tokens - 1)
+        return self
+
+    def record(self, latency_tracker, prefix):
+        """Add `<prefix>_ttft` and `<prefix>_tpot` to a LatencyTracker."""
+        if latency_tracker is None:
+            return
+        if self.ttft is not None:
+            latency_tracker.add(f"{prefix}_ttft", self.ttft)
+        if self.tpot is not None:
+            latency_tracker.add(f"{prefix}_tpot", self.tpot)
+
+class LatencyTracker():
+    """
+    Thread-safe recorder of wall-clock latency (seconds) per named stage, e.g. "agent", "search", "answer".
+    A single instance can be shared by all agents of a batch run.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = defaultdict(list)
+
+    @contextmanager
+    def track(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.records[stage].append(seconds)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        Return {stage: {'count': ..., 'mean': ..., 'p50': ..., ...}}
+        """
+        with self.lock:
+            records = {stage: list(values) for stage, values in self.records.items()}
+
+        result = {}
+        for stage, values in records.items():
+            stats = {'count': len(values), 'mean': sum(values) / len(values)}
+            for q in percentiles:
+                stats[f"p{q}"] = percentile(values, q)
+            result[stage] = stats
+        return result
+
+    def print_summary(self, percentiles=(50, 90, 99)):
+        summary = self.summary(percentiles)
+        header = f"{'stage':<14}{'count':>8}{'mean':>10}" + ''.join(f"{'p' + str(q):>10}" for q in percentiles)
+        print(header)
+        for stage, stats in summary.items():
+            row = f"{stage:<14}{stats['count']:>8}{stats['mean']:>10.3f}"
+            row += ''.join(f"{stats['p' + str(q)]:>10.3f}" for q in percentiles)
+            print(row)
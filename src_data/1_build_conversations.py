@@ -2,12 +2,13 @@ import os
 import random
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed  # ThreadPool import
-from transformers import AutoTokenizer
 from typing import List, Dict, Any
 import copy
 import yaml
 
 from src.rag_engine import RAGEngine
+from src.http_client import HTTPClient, set_http_client
+from src.tokenizer_registry import get_tokenizer
 from src.prompts import data_construction_qwq, long_ans_prompt
 from src_data.utils import read_jsonl, parse_reasoning_steps, format_thought_action, \
                     postprocess_codes, preprocess_question, get_response, \
@@ -184,8 +185,9 @@ def initialize():
     global llm_api, llm_tokenizer, rag_engine
 
     llm_api = config['llm_api']
-    llm_tokenizer = AutoTokenizer.from_pretrained(config['llm_tokenizer_path'], trust_remote_code=True)
-    ans_tokenizer = AutoTokenizer.from_pretrained(config['ans_tokenizer_path'], trust_remote_code=True)
+    set_http_client(HTTPClient(pool_maxsize=config['num_workers']))
+    llm_tokenizer = get_tokenizer(config['llm_tokenizer_path']).prefetch()
+    ans_tokenizer = get_tokenizer(config['ans_tokenizer_path']).prefetch()
 
     # Init RAG engine
     rag_engine = RAGEngine(
@@ -3,13 +3,13 @@ This script clean the conversations build from build_conversations.py, the crite
 * the conversation must be valid, and the answer achieved F1 score > 0.
 """
 
-import re
 import copy
 import os
 import argparse
 import yaml
 
 from src_data.utils import parse_reasoning_steps, read_jsonl, save_json
+from src.action_parser import THOUGHT_ACTION_PATTERN, parse_action
 from src_data.metrics import qa_f1_score
 
 with open('src_data/data_config.yaml', 'r') as f:
@@ -85,7 +85,7 @@ def check_valid_conversation(convs, gt_answer):
             expected_thought_num += 1
 
             # Check rule (2) and (3) regarding what must follow
-            prev_assistant_action = eval(action_str)['function']
+            prev_assistant_action = parse_action(action_str)['function']
 
             # If the previous assistant action was NOT "reflect", we needed an observation here (rule #2).
             if i + 1 < len(convs) and convs[i + 1]["role"] != "observation":
@@ -129,7 +129,7 @@ def check_valid_conversation(convs, gt_answer):
         return False, "Last assistant action must be 'finish'."
 
     # If all rules are satisfied, now we check if prediction is correct (rule #6)
-    prediction = eval(last_action_str)['parameters']['answer']
+    prediction = parse_action(last_action_str)['parameters']['answer']
     score = qa_f1_score(gt_answer, prediction)
     if score == 0:
         return False, "Prediction is incorrect."
@@ -155,8 +155,7 @@ def main():
             for i, conv in enumerate(item):
                 if conv['role'] == 'assistant':
                     # Try to separate reasoning steps that contains multiple Thought if they are combined
-                    pattern = re.compile(r'^(Thought|Action)\s+(\d+):', re.MULTILINE)
-                    reasoning_steps = parse_reasoning_steps(conv['reasoning'], pattern)
+                    reasoning_steps = parse_reasoning_steps(conv['reasoning'], THOUGHT_ACTION_PATTERN)
                     tgt_data_processed.extend([{'role': 'assistant', 'reasoning': step} for step in reasoning_steps])
                 else:
                     tgt_data_processed.append(conv)
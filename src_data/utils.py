@@ -1,7 +1,7 @@
 import json
-import re
-import requests
 from termcolor import colored
+from src.http_client import get_http_client
+from src.action_parser import extract_code, parse_action, parse_reasoning_steps
 
 def get_response(prompt, base_url, parameters=None):
     if parameters is None:
@@ -12,15 +12,12 @@ def get_response(prompt, base_url, parameters=None):
                 # "stop": ["<|im_end|>", "<|endoftext|>", "<|im_start|>"],
             }
     try:
-        rep = requests.post(
+        rep = get_http_client().post_json(
             base_url,
-            json={
+            {
                 'inputs': prompt,
                 "parameters": parameters
             },
-            headers={
-                'Content-Type': 'application/json'
-            },
             timeout=500
         )
         rep.raise_for_status()  # <-- raises an HTTPError if status != 200
@@ -43,96 +40,6 @@ Action {turn}:
 {action}
 ```"""
 
-def extract_code(text: str) -> str:
-    triple_match = re.search(r'```[^\n]*\n(.+?)```', text, re.DOTALL)
-    single_match = re.search(r'`([^`]*)`', text, re.DOTALL)
-    if triple_match:
-        return triple_match.group(1)
-    elif single_match:
-        return single_match.group(1)
-    return text
-
-def parse_reasoning_steps(text: str, pattern=None):
-    """
-    Parse a string containing Thought/Action/Observation steps (including multi-line)
-    and return a list of dictionaries of the form:
-    
-    [
-        {
-            "1": {
-                "Thought": "...",
-                "Action": "...",  # Only content inside backticks (if present)
-                "Observation": "..."
-            }
-        },
-        {
-            "2": {
-                "Thought": "...",
-                "Action": "...",
-                "Observation": "..."
-            }
-        },
-        ...
-    ]
-    """
-    # Regex pattern to match lines that start with "Thought X:", "Action X:", or "Observation X:".
-    if pattern is None:
-        pattern = re.compile(r'^(Thought|Action|Observation)\s+(\d+):', re.MULTILINE)
-
-    # This dictionary will accumulate:
-    # data_dict[step_number] = {"Thought": ..., "Action": ..., "Observation": ...}
-    data_dict = {}
-
-    # We'll track the current label (Thought/Action/Observation) and step number
-    current_label = None
-    current_step = None
-    last_pos = 0
-
-    # Find all pattern occurrences in the text
-    matches = list(pattern.finditer(text))
-
-    for match in matches:
-        # If we already have a label in progress, we can record its content
-        if current_label is not None:
-            # Slice the text from the last match's end to the start of this new match
-            content = text[last_pos:match.start()].strip()
-            # Store that content in data_dict
-            data_dict[current_step][current_label] = content
-
-        # Extract the new label and step
-        label = match.group(1)       # "Thought", "Action", or "Observation"
-        step = match.group(2)        # e.g. "1", "2", "3"
-
-        # Ensure a dict for this step
-        if step not in data_dict:
-            data_dict[step] = {"Thought": None, "Action": None, "Observation": None}
-
-        # Update current label/step
-        current_label = label
-        current_step = step
-        # We'll slice from here next time
-        last_pos = match.end()
-
-    # Handle the final block after the last match
-    if current_label is not None:
-        content = text[last_pos:].strip()
-        data_dict[current_step][current_label] = content
-
-    # Post-process:
-    #  - For each step, extract only the text inside triple backticks for "Action".
-    for step_number in data_dict:
-        action_text = data_dict[step_number]["Action"]
-        if action_text:
-            # Extract content inside triple backticks
-            data_dict[step_number]["Action"] = extract_code(action_text)
-
-    # Convert our dictionary to the desired list-of-dicts structure
-    structured_data = []
-    for step_number in sorted(data_dict.keys(), key=lambda x: int(x)):
-        structured_data.append({step_number: data_dict[step_number]})
-
-    return structured_data
-
 def read_json(filepath):
     with open(filepath, 'r') as f:
         data = json.load(f)
@@ -172,7 +79,7 @@ def verify_reasoning_steps(reasoning_steps, allowed_actions):
             
             # Verify if action is valid dict
             try:
-                action_type = eval(action)['function']
+                action_type = parse_action(action)['function']
             except Exception as e:
                 print(f"Error in verify_reasoning_steps, not valid dict: {e}\nGot action: {action}")
                 return False
@@ -210,7 +117,7 @@ def postprocess_codes(reasoning_steps):
     for steps in reasoning_steps:
         for step_idx, step in steps.items():
             # thought = f"Thought {step_idx}: {step['Thought']}"
-            action = eval(extract_code(step['Action']))
+            action = parse_action(extract_code(step['Action']))
 
             thoughts.append(step['Thought'])
             actions.append(action)
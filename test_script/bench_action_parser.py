@@ -0,0 +1,53 @@
+"""
+Microbenchmark of src.action_parser against the previous eval()-based parsing.
+Runs offline, no deployment needed:
+    python -m test_script.bench_action_parser
+"""
+import re
+import timeit
+import argparse
+
+from src.action_parser import parse_action, parse_reasoning_steps
+
+ACTIONS = {
+    "canonical": "{'function': 'search', 'parameters': {'query': 'Who is the author of Hannibal and Scipio?'}}",
+    "double_quoted": '{"function": "finish", "parameters": {"answer": "Trinity College, Dublin"}}',
+    "escaped_quote": "{'function': 'search', 'parameters': {'query': 'Where was Hannibal\\'s army defeated?'}}",
+}
+
+RESPONSE = """Thought 1: I need to find the author of Hannibal and Scipio first.
+Action 1:
+```
+{'function': 'search', 'parameters': {'query': 'Who is the author of Hannibal and Scipio?'}}
+```"""
+
+def eval_parse(text):
+    return eval(text)
+
+def parse_reasoning_steps_uncompiled(text):
+    # Regex compiled on every call, as before
+    pattern = re.compile(r'^(Thought|Action|Observation)\s+(\d+):', re.MULTILINE)
+    return parse_reasoning_steps(text, pattern)
+
+def bench(stmt, number):
+    seconds = min(timeit.repeat(stmt, number=number, repeat=5))
+    return seconds / number * 1e6
+
+def main(args):
+    print(f"{'case':<16}{'eval (us)':>12}{'parse_action (us)':>20}{'speedup':>10}")
+    for name, text in ACTIONS.items():
+        assert parse_action(text) == eval(text)
+        t_eval = bench(lambda: eval_parse(text), args.number)
+        t_parse = bench(lambda: parse_action(text), args.number)
+        print(f"{name:<16}{t_eval:>12.2f}{t_parse:>20.2f}{t_eval / t_parse:>9.1f}x")
+
+    t_old = bench(lambda: parse_reasoning_steps_uncompiled(RESPONSE), args.number)
+    t_new = bench(lambda: parse_reasoning_steps(RESPONSE), args.number)
+    print(f"\nparse_reasoning_steps, regex compiled per call: {t_old:.2f} us, precompiled: {t_new:.2f} us")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark action parsing')
+    parser.add_argument('--number', type=int, default=20000, help="calls per measurement")
+    args = parser.parse_args()
+
+    main(args)
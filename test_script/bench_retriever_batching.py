@@ -0,0 +1,69 @@
+"""
+Throughput of /search of deploy/retriever_serving.py at several concurrency levels,
+with server-side batching against the per-request path. Start two retrievers from the same config:
+    python retriever_serving.py --port 9892 --max_batch_size 1
+    python retriever_serving.py --port 9894 --max_batch_size 32 --max_batch_wait_ms 5
+then, from ReaRAG/:
+    python -m test_script.bench_retriever_batching \
+        --baseline_api http://127.0.0.1:9892/search --batched_api http://127.0.0.1:9894/search
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from src.http_client import HTTPClient
+from src.utils import percentile
+
+QUERIES = [
+    "Who is the author of Hannibal and Scipio?",
+    "Where was Thomas Nabbes educated?",
+    "Who is part of The Bruce Lee Band?",
+    "What is the capital of the country where the Nile ends?",
+    "When was the University of Oxford founded?",
+    "Who directed the film Inception?",
+    "Which river flows through Dublin?",
+    "What language is spoken in Brazil?",
+]
+
+def run_level(client, url, concurrency, n_requests, top_n):
+    def search(i):
+        start = time.perf_counter()
+        rep = client.post_json(url, {'query': QUERIES[i % len(QUERIES)], 'top_n': top_n, 'return_score': True}, timeout=300)
+        rep.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(search, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    return n_requests / elapsed, percentile(latencies, 50), percentile(latencies, 99)
+
+def main(args):
+    client = HTTPClient(pool_maxsize=max(args.concurrency))
+    apis = {'per-request': args.baseline_api, 'batched': args.batched_api}
+
+    # Same index, same documents. Scores may differ in the last bits, as the encoder pads batches
+    for query in QUERIES:
+        payload = {'query': query, 'top_n': args.top_n, 'return_score': True}
+        baseline_docs, _ = client.post_json(args.baseline_api, payload).json()
+        batched_docs, _ = client.post_json(args.batched_api, payload).json()
+        assert [doc['id'] for doc in baseline_docs] == [doc['id'] for doc in batched_docs], query
+
+    print(f"{'concurrency':>12}{'mode':>14}{'qps':>10}{'p50 (ms)':>12}{'p99 (ms)':>12}")
+    for concurrency in args.concurrency:
+        for mode, url in apis.items():
+            run_level(client, url, concurrency, min(concurrency, len(QUERIES)), args.top_n) # warm up
+            qps, p50, p99 = run_level(client, url, concurrency, args.n_requests, args.top_n)
+            print(f"{concurrency:>12}{mode:>14}{qps:>10.1f}{p50 * 1e3:>12.1f}{p99 * 1e3:>12.1f}")
+    client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark server-side batching of the retriever')
+    parser.add_argument('--baseline_api', type=str, required=True, help="/search of a retriever started with --max_batch_size 1")
+    parser.add_argument('--batched_api', type=str, required=True, help="/search of a retriever started with batching")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--n_requests', type=int, default=512, help="requests per concurrency level")
+    parser.add_argument('--top_n', type=int, default=3)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,62 @@
+"""
+Benchmark of the HTTP and in-process retriever transports of RAGEngine.
+Needs a retriever deployed with deploy/retriever_serving.py, built from the same config:
+    PYTHONPATH=deploy python -m test_script.bench_retriever_transport \
+        --retriever_api http://host:port/search --retriever_config deploy/retriever_config.yaml
+"""
+import time
+import argparse
+
+from src.retriever_transport import HTTPRetrieverTransport, LocalRetrieverTransport
+
+QUERIES = [
+    "Who is the author of Hannibal and Scipio?",
+    "Where was Thomas Nabbes educated?",
+    "Who is part of The Bruce Lee Band?",
+    "What is the capital of the country where the Nile ends?",
+    "When was the University of Oxford founded?",
+    "Who directed the film Inception?",
+    "Which river flows through Dublin?",
+    "What language is spoken in Brazil?",
+]
+
+def bench_search(transport, queries, top_n, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for query in queries:
+            transport.search(query, top_n)
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1e3
+
+def bench_batch_search(transport, queries, top_n, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        transport.batch_search(queries, top_n)
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1e3
+
+def main(args):
+    transports = {
+        'http': HTTPRetrieverTransport(args.retriever_api),
+        'local': LocalRetrieverTransport(args.retriever_config),
+    }
+
+    # Both transports must return the same documents and scores
+    for query in QUERIES:
+        assert transports['http'].search(query, args.top_n) == transports['local'].search(query, args.top_n), query
+    assert transports['http'].batch_search(QUERIES, args.top_n) == transports['local'].batch_search(QUERIES, args.top_n)
+    print(f"Identical results for {len(QUERIES)} queries, top_n={args.top_n}")
+
+    print(f"{'transport':<12}{'search (ms/query)':>20}{'batch_search (ms/query)':>26}")
+    for name, transport in transports.items():
+        t_search = bench_search(transport, QUERIES, args.top_n, args.repeat)
+        t_batch = bench_batch_search(transport, QUERIES, args.top_n, args.repeat)
+        print(f"{name:<12}{t_search:>20.2f}{t_batch:>26.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark retriever transports')
+    parser.add_argument('--retriever_api', type=str, required=True, help="/search URL of retriever_serving.py")
+    parser.add_argument('--retriever_config', type=str, required=True, help="flashrag config of the same retriever")
+    parser.add_argument('--top_n', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,67 @@
+"""
+Startup time of tokenizer loading: AutoTokenizer.from_pretrained against src.tokenizer_registry.
+Tokenizers that are not cacheable (remote code or no fast implementation, e.g. the GLM-4 tokenizers
+of ReaRAG-9B and glm-4-9b-chat) are reported: for them, the warm cache only saves the overlap of loading.
+Every measurement runs in a fresh interpreter, as a real startup would:
+    python -m test_script.bench_tokenizer_startup --rearag_tokenizer_path ... --ans_tokenizer_path ...
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+DIRECT = """
+from transformers import AutoTokenizer
+rearag_tokenizer = AutoTokenizer.from_pretrained({rearag!r}, trust_remote_code=True)
+ans_tokenizer = AutoTokenizer.from_pretrained({ans!r}, trust_remote_code=True)
+rearag_tokenizer.encode("warm up")
+ans_tokenizer.encode("warm up")
+"""
+
+REGISTRY = """
+from src.tokenizer_registry import get_tokenizer
+rearag_tokenizer = get_tokenizer({rearag!r}).prefetch()
+ans_tokenizer = get_tokenizer({ans!r}).prefetch()
+rearag_tokenizer.encode("warm up")
+ans_tokenizer.encode("warm up")
+"""
+
+def run(code, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+    return time.perf_counter() - start
+
+def main(args):
+    paths = {'rearag': args.rearag_tokenizer_path, 'ans': args.ans_tokenizer_path}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {**os.environ, "REARAG_TOKENIZER_CACHE": cache_dir}
+        results = {
+            'AutoTokenizer': min(run(DIRECT.format(**paths), env) for _ in range(args.repeat)),
+            'registry, cold cache': run(REGISTRY.format(**paths), env),
+            'registry, warm cache': min(run(REGISTRY.format(**paths), env) for _ in range(args.repeat)),
+        }
+        os.environ["REARAG_TOKENIZER_CACHE"] = cache_dir
+        from src.tokenizer_registry import cache_path
+        cached = {}
+        for name, path in paths.items():
+            entry = cache_path(path)
+            cached[name] = entry is not None and os.path.exists(os.path.join(entry, "tokenizer.json"))
+
+    print(f"{'loading':<24}{'startup (s)':>14}")
+    for name, seconds in results.items():
+        print(f"{name:<24}{seconds:>14.2f}")
+    for name, path in paths.items():
+        if not cached[name]:
+            print(f"{name} tokenizer {path} is not cached (remote code, no fast implementation, or unknown revision): "
+                  f"the warm cache run loads it like AutoTokenizer")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark tokenizer startup time')
+    parser.add_argument('--rearag_tokenizer_path', type=str, required=True)
+    parser.add_argument('--ans_tokenizer_path', type=str, required=True)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per measurement, the fastest is reported")
+    args = parser.parse_args()
+
+    main(args)